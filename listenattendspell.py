@@ -3,15 +3,17 @@
 
 
 import os
+import sys
 import time
+import atexit
+import resource
+import subprocess
 import datetime
 import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
 from tensorflow.keras import models
-import tensorflow_probability as tfp
-from tensorflow.keras.layers.experimental import preprocessing
 
 
 # GPU memory hack
@@ -28,25 +30,60 @@ tf.random.set_seed(1)
 
 # data
 mel_dim      = 40    # free choice, number of logmels
-voc_dim      = 123   # one more than the highest unicode value in the vocabulary, which is 122 for 'z'.
+voc_chars    = "abcdefghijklmnopqrstuvwxyz0123456789 ,.'?^$"
                      # the vocab is {a,b,c...z,0...9,<space>,<comma>,<period>,<apost>,<unk>} + {<sos>,<eos>}
-                     # where <unk> is ?, <sos> is ^, and <eos> is $.
+                     # where <unk> is ?, <sos> is ^, and <eos> is $.  Each char's id is its index in voc_chars.
+voc_dim      = len(voc_chars) # 43, the number of character ids
 sample_rate  = 16000 # from LibriSpeech
+use_cache    = False # free choice, compute training logmels once and read them back from a memory-mapped cache
+cache_dir    = './feature_cache' # free choice, the feature cache makes one subdirectory per front-end configuration
+use_corpus   = False # free choice, read waveforms from a memory-mapped flat int16 corpus instead of through tfds
+corpus_dir   = './audio_corpus'  # free choice, the audio corpus makes one subdirectory per split
 # model
 lis_dim      = 256   # free choice, listener dimension (of each LSTM)
 lis_layers   = 3     # free choice, number of layers in the listener
 dec_dim      = 512   # free choice, dimension of the DecoderCell's internal LSTM
 att_dim      = 512   # free choice, dimension of MLPs used to compute attention queries and keys
+chr_dim      = 492   # free choice, hidden dimension of the character distribution MLP
+                     # 492 was voc_dim * 4 with the original 123 code point vocabulary, so old checkpoints convert
+hoist_inputs = True  # free choice, when teacher-forcing compute the decoder's y input projections before its loop
+convert_from = None  # free choice, path of a code point vocabulary checkpoint to convert, see convert_checkpoint()
 # training
-norm_count   = 1000  # free choice, the number of normalization adaptation examples, 1000 takes < 1 minute
+norm_only    = False # free choice, just compute (and save) the normalization statistics and then stop
+run_bench    = False # free choice, just benchmark the input pipeline stages, see benchmark_pipeline(), and then stop
+bench_utts   = 256   # free choice, number of utterances the pipeline benchmark reads
 frac_pyp     = 0.1   # free choice, the fraction of previous y predictions to use as y input
                      # This enables me to train as in the paper, either with frac_pyp = 0 or frac_pyp = 0.1
 batch_size   = 32    # Limited by the amount of memory in the GPU; most efficiently a power of 2
+bkt_frames   = [400, 600, 800, 1000, 1200, 1400] # free choice, frame count boundaries between batching buckets
+bkt_sizes    = [32, 32, 32, 32, 32, 32, 32]      # free choice, batch size in each of the len(bkt_frames)+1 buckets
+bkt_chars    = []    # free choice, optional character count boundaries which further split every frame bucket
+bkt_budget   = 0     # free choice, if > 0 each bucket's batch size is instead budget // (max frames * max chars)
+                     # 32 * 1700 * 302 would bound memory like batch_size 32 does for the longest examples
+max_frames   = 1700  # free choice, maximum number of 10ms frames allowed in training data (1700 is 17s)
+noise_bank   = 4     # free choice, length of the augmentation noise bank as a multiple of the longest shifted waveform
 max_chars    = 300   # free choice, maximum number of characters allowed in training data (capped at 300)
 num_epochs   = 11    # free choice, number of epochs of training
+resume_every = 500   # free choice, batches between resumable checkpoints of the training state (0 for none)
+
+# pipeline
+num_parallel = tf.data.experimental.AUTOTUNE # free choice, parallel calls of each pipeline map function
+prefetch_num = tf.data.experimental.AUTOTUNE # free choice, number of batches prepared ahead of the training step
+ordered      = True  # free choice, False lets tf.data return elements out of order rather than wait for slow ones
+ram_budget   = 0     # free choice, bytes of RAM tf.data autotuning may use for its buffers, 0 for the default
+shuf_window  = 256   # free choice, examples in the window shuffle applied after the tfds file shuffle
+read_cycle   = 16    # free choice, tfds files read at once, interleaved one utterance at a time
+vec_frontend = False # free choice, batch raw waveforms, then augment and compute logmels a whole batch at a time
+aug_mode     = 'wave' # free choice, 'wave' for wav_augment, 'logmel' for logmel_augment (which use_cache always uses)
+time_mask    = 20    # free choice, maximum width in frames of logmel_augment's time mask
+freq_mask    = 6     # free choice, maximum width in logmels of logmel_augment's frequency mask
+svc_workers  = 0     # free choice, if > 0 the training pipeline runs on a local tf.data service with this many workers
+svc_port     = 5050  # free choice, localhost port of the tf.data service dispatcher
+svc_smoke    = False # free choice, just check the tf.data service on localhost, see smoke_test_service(), and stop
 
 # decoding
 max_dec      = 300   # free choice, maximum number of characters to decode for if <eos> token is not found
+fold_norm    = False # free choice, fold the logmel normalization into the listener for prediction
 
 
 # Data
@@ -60,13 +97,18 @@ builder  = tfds.builder("librispeechpartial")
 info     = builder.info
 # dev_ds   = builder.as_dataset(split="dev_clean")
 # test_ds  = builder.as_dataset(split="test_clean")
-train_ds = builder.as_dataset(split="train_clean100")
+# The order of the training files is shuffled every epoch, and read_cycle of them are read at a time,
+# taking one utterance from each in turn, so neighbouring utterances come from different files, see
+# build_pipeline().  (The tfds default takes 16 consecutive utterances from each file.)
+read_config = tfds.ReadConfig(interleave_cycle_length=read_cycle, interleave_block_length=1)
+train_ds = builder.as_dataset(split="train_clean100", shuffle_files=True, read_config=read_config)
 
 
 # Filter out examples longer than I want to use.
 # There are a few extremely long examples that cause training to fall over (exceed GPU memory).
 # Speech length 17s and text length 300 were chosen to exclude less than 0.5% of my data.
 # This enabled me to run an early system with batch_size=8 on my machine.
+# With a bkt_budget the batch shrinks as the examples get longer, so max_frames can be raised.
 # The tf.minimum allows max_chars to override the 300 character machine limit.
 # This function comes first in the pipeline so I don't waste time processing speech I'm not going to use.
 @tf.autograph.experimental.do_not_convert
@@ -75,106 +117,270 @@ def filter_lengths(d):
     text      = d['text']                     # ()
     speechl   = tf.shape(speech)[0]
     textl     = tf.strings.length(text)
-    speechlim = 272000                        # 1700 frames at 10ms = 17s = 272,000 samples at 16kHz
+    speechlim = max_frames * sample_rate // 100 # 1700 frames at 10ms = 17s = 272,000 samples at 16kHz
     textlim   = tf.minimum(max_chars, 300)
     return tf.math.logical_and(speechl <= speechlim, textl <= textlim)
 
 
-filt_ds = train_ds.filter(filter_lengths)
+# map function to store the waveform as int16s.  tfds gives LibriSpeech's 16 bit samples as int64s,
+# so this quarters the memory taken by every waveform held in the shuffle buffer, batches and prefetch
+# buffers, and the bandwidth of every copy of them, upstream of the conversion to floats.
+@tf.autograph.experimental.do_not_convert
+def to_int16(d):
+    d['speech'] = tf.cast(d['speech'], dtype=tf.int16)
+    return d
+
+
+# Convert a waveform (or batch of waveforms) of int samples into floats in [-1, 1).  A waveform that
+# is already floats has been converted (by the augmentation) and is returned as it is, so the samples
+# are converted just once, on their way to the STFT.
+def wave_to_float(w):
+    if w.dtype.is_floating:
+        return w
+    return tf.cast(w, dtype=tf.float32) / 32768.0
+
+
+# The white noise used by the waveform augmentation is sliced at random offsets from one bank of uniform
+# randoms on [0,1), made once here, rather than drawn afresh for every sample of every utterance.
+# It holds noise_bank times the longest shifted waveform, so every slice fits and slices rarely coincide.
+max_shift  = 2 ** lis_layers * (sample_rate * 10 // 1000)
+noise_len  = noise_bank * (max_frames * sample_rate // 100 + max_shift)
+noise_bank_t = tf.constant(np.random.default_rng(1).random(noise_len, dtype=np.float32))
+
+
+# Every augmentation draws its random numbers from a seed of its own, [k, 0] for the k'th example (or
+# batch), which add_aug_seeds() zips in from a (practically endless) range.  The augmentation is then a
+# pure function of the example and its seed, and the position in the range is part of the saved state of
+# the pipeline's iterator, so a restored iterator goes on augmenting exactly as the original would.
+# A range rather than a RandomDataset (or a Counter), because the tf.data service splits a range between
+# its workers, while every worker would run its own copy of the others and repeat each other's seeds.
+def add_aug_seeds(pds):
+    seeds = tf.data.Dataset.range(2 ** 62).map(lambda k: tf.stack([k, tf.zeros_like(k)]))
+    return tf.data.Dataset.zip((pds, seeds)).map(lambda d, s: dict(d, aug_seed=s))
 
 
-# Shuffle the training dataset.
-# Buffer size 2048 adds about 4GB to the resident memory size (non GPU) taking it to 9GB.
-shuf_ds = filt_ds.shuffle(2048, reshuffle_each_iteration=True, seed=1)
+# the seed for the k'th random draw from an example's aug_seed
+def draw_seed(aug_seed, k):
+    return aug_seed + tf.constant([0, k], dtype=tf.int64)
 
 
 # map function to augment the waveform data by shifting, scaling, and adding noise
+# The waveform is scaled and noised as it is, and then shifted once, at the end, by the one padding that
+# makes the output, so no shifted copy is made just to be scaled and noised.
 @tf.autograph.experimental.do_not_convert
 def wav_augment(d):
+    seed = d.pop('aug_seed') # -> (2,)
     wi = d['speech']         # -> (samples)
-    wf = tf.cast(wi, dtype=tf.float32)
-    # calculate the max_shift; with a 3-layer listener this will usually be 80ms = 1280 samples
-    frame_step = tf.constant(sample_rate * 10 // 1000)    
-    max_shift  = 2 ** lis_layers * frame_step 
-    # the waveform shift in samples is random in [0, max_shift)
-    shift = tf.random.uniform(shape=[], minval=0, maxval=max_shift, dtype=tf.int32, seed=1)
-    zeros = tf.zeros((shift,))
-    # the shifted waveform of floats
-    swf   = layers.concatenate([zeros, wf])
+    wf = wave_to_float(wi)
+    # the waveform shift in samples is random in [0, max_shift); with a 3-layer listener max_shift
+    # will usually be 80ms = 1280 samples
+    shift = tf.random.stateless_uniform([], draw_seed(seed, 0), minval=0, maxval=max_shift, dtype=tf.int32)
     # the waveform scale is a float in [0.8, 1.0)
-    scale = tf.random.uniform(shape=[], minval=0.8, maxval=1.0, seed=1)
-    # the scaled shifted waveform of floats
-    sswf  = swf * scale
+    scale = tf.random.stateless_uniform([], draw_seed(seed, 1), minval=0.8, maxval=1.0)
     # the noise scale is a random float in [0, 1-scale)
-    noisescale = tf.random.uniform(shape=[], minval=0, maxval=1.0-scale, seed=1)
-    # the white noise is random floats on [0,1)
-    nsamples   = tf.shape(sswf)[0]
-    whitenoise = tf.random.uniform(shape=[nsamples], minval=0, maxval=1.0, seed=1)
-    # the actual noise is also scaled by the shifted speech waveform
+    noisescale = tf.random.stateless_uniform([], draw_seed(seed, 2), minval=0, maxval=1.0-scale)
+    # the white noise is random floats on [0,1), a slice of the noise bank at a random offset
+    nsamples   = tf.shape(wf)[0]
+    offset     = tf.random.stateless_uniform([], draw_seed(seed, 3), minval=0, maxval=noise_len - nsamples + 1,
+                                             dtype=tf.int32)
+    whitenoise = noise_bank_t[offset:offset + nsamples]
+    # the scaled waveform plus noise, which is also scaled by the speech waveform
     # the idea is that some fraction of the signal already taken out is put back in as noise
     # the 0.8 above results in the worst cases sounding slighly hissy
-    noise = swf * noisescale * whitenoise
-    ssnwf = sswf + noise
-    # cast back to int64s
-    nwi   = tf.cast(ssnwf, dtype=tf.int64)
-    # put back in the dict
-    d['speech'] = nwi
+    snwf  = wf * (scale + noisescale * whitenoise)
+    # shifted, starting shift samples in, and put back in the dict, as floats which go straight to the STFT
+    d['speech'] = tf.pad(snwf, [[shift, 0]])
+    return d
+
+
+# The number of frames that speech_to_logmels() makes from nsamples samples, which may be a tensor of lengths.
+# This is the number of whole 25ms frames at 10ms steps, rounded down to a multiple of 2 ** lis_layers.
+def wave_frames(nsamples):
+    frame_length = sample_rate * 25 // 1000
+    frame_step   = sample_rate * 10 // 1000
+    pd = 2 ** lis_layers
+    nf = tf.maximum(0, 1 + (nsamples - frame_length) // frame_step)
+    return nf // pd * pd
+
+
+# With vec_frontend the waveforms are padded and batched first, and then augmented and converted into
+# logmels a whole batch at a time, so that each op is dispatched once per batch instead of once per
+# utterance.  The following functions do this.
+#
+# map function preparing a Librispeech dictionary for batching with vec_frontend.  The text is converted
+# as in transform() but the speech stays a waveform.  speech_len is its number of samples, and logmel_len
+# the number of frames it will make if it's not shifted, which is all bucket_batch() needs to know.
+@tf.autograph.experimental.do_not_convert
+def prepare_wave(d):
+    speech = d['speech']                    # (samples,)
+    ysp    = text_to_ygt(d['text'])         # (nchars,)
+    nsamp  = tf.shape(speech)[0]
+    o = {'speech' : speech, 'speech_len' : nsamp, 'logmel_len' : wave_frames(nsamp),
+         'speaker_id' : d['speaker_id'], 'ygt' : ysp, 'ygt_len' : tf.shape(ysp)[0]}
+    return o
+
+
+# the padded shapes of the prepare_wave() dictionaries when batched
+wave_shapes = {'speech' : (None,), 'speech_len' : (), 'logmel_len' : (), 'speaker_id' : (),
+               'ygt'    : (None,), 'ygt_len'    : ()}
+
+
+# map function to augment a batch of waveforms like wav_augment, with each example getting its own random
+# shift, scale and noise.  The random numbers are drawn for the whole batch at once, and then each example
+# is scaled and noised, with its white noise sliced straight from the noise bank, and shifted by the one
+# padding that makes its output row.  There's room for the biggest shift in max_shift extra samples, and
+# the speech lengths grow by the shifts.
+@tf.autograph.experimental.do_not_convert
+def batch_wav_augment(d):
+    seed = d.pop('aug_seed')          # -> (2,), one for the whole batch
+    wf = wave_to_float(d['speech'])   # -> (batch, samples)
+    bs = tf.shape(wf)[0]
+    ns = tf.shape(wf)[1]
+    # random per-example shift in [0, max_shift), scale in [0.8, 1.0), noise scale in [0, 1-scale),
+    # and noise bank offset
+    shift      = tf.random.stateless_uniform([bs], draw_seed(seed, 0), minval=0,   maxval=max_shift, dtype=tf.int32)
+    scale      = tf.random.stateless_uniform([bs], draw_seed(seed, 1), minval=0.8, maxval=1.0)
+    noisescale = tf.random.stateless_uniform([bs], draw_seed(seed, 2), minval=0,   maxval=1.0) * (1.0 - scale)
+    offset     = tf.random.stateless_uniform([bs], draw_seed(seed, 3), minval=0,   maxval=noise_len - ns + 1,
+                                             dtype=tf.int32)
+    #
+    def augment_row(row):
+        w, sh, sc, nsc, off = row
+        whitenoise = noise_bank_t[off:off + ns]
+        return tf.pad(w * (sc + nsc * whitenoise), [[sh, max_shift - sh]])
+    #
+    d['speech']     = tf.map_fn(augment_row, (wf, shift, scale, noisescale, offset),
+                                fn_output_signature=tf.float32)   # -> (batch, samples + max_shift)
+    d['speech_len'] = d['speech_len'] + shift
     return d
 
 
-# apply waveform augmentation
-waug_ds = shuf_ds.map(wav_augment)
+# map function to convert a batch of prepare_wave() dictionaries into a batch of transform() dictionaries.
+# The STFT frames are computed independently, so each example's real frames are exactly the frames
+# transform() would make; the rest, made from the padding, are beyond its logmel_len.
+@tf.autograph.experimental.do_not_convert
+def batch_transform(d):
+    wf   = wave_to_float(d['speech'])
+    sf   = get_spectrogram(wf)             # -> (batch, frames, mel_dim)
+    lens = wave_frames(d['speech_len'])    # -> (batch,)
+    sp   = sf[:, :tf.reduce_max(lens), :]
+    o = {'logmels' : sp,       'logmel_len' : lens,         'speaker_id' : d['speaker_id'],
+         'ygt'     : d['ygt'], 'ygt_len'    : d['ygt_len']}
+    return o
 
 
 # tfio versions compatible with TensorFlow 2.3.0 do not have tfio.audio.spectrogram()
-# so I use tf.signal instead
+# so I use tf.signal instead.
+# The log mel front end is a layer, which makes its STFT window and mel weight matrix just once, when
+# it's constructed, rather than on every call.  The same layer computes the logmels in the input
+# pipeline (through get_spectrogram()) and can sit inside a model, so that training and serving share
+# one in-graph front end.
+class LogMelFrontend(keras.layers.Layer):
+    def __init__(self, mel_dim, sample_rate, **kwargs):
+        super(LogMelFrontend, self).__init__(**kwargs)
+        self.mel_dim      = mel_dim
+        self.sample_rate  = sample_rate
+        # 25ms frames every 10ms, with the FFT length tf.signal.stft() would use by default
+        self.frame_length = sample_rate * 25 // 1000
+        self.frame_step   = sample_rate * 10 // 1000
+        self.fft_length   = 2 ** int(np.ceil(np.log2(self.frame_length)))
+        self.window       = tf.signal.hann_window(self.frame_length)
+        # Warp the linear scale spectrograms into the mel-scale, between 80Hz and 7.6kHz.
+        self.mel_matrix   = tf.signal.linear_to_mel_weight_matrix(
+            mel_dim, self.fft_length // 2 + 1, sample_rate, 80.0, 7600.0)
+        #
+    def logmels(self, waves):
+        """Adapted from help(tf.signal.mfccs_from_log_mel_spectrograms)
+        inputs  : waveform tensor, shape (..., samples) with floating point values in [-1, 1]
+        returns : log mel spectrograms, shape (..., frames, mel_dim) as float32s
+                  ... means the batch dimension is optional
+        """
+        # produces shape (..., frames, fftbins)
+        stfts = tf.signal.stft(waves, self.frame_length, self.frame_step, self.fft_length,
+                               window_fn=lambda n, dtype: self.window)
+        spectrograms = tf.abs(stfts)
+        mel_spectrograms = tf.tensordot(spectrograms, self.mel_matrix, 1)
+        mel_spectrograms.set_shape(spectrograms.shape[:-1].concatenate(self.mel_matrix.shape[-1:]))
+        # Compute a stabilized log to get log-magnitude mel-scale spectrograms, shape (..., frames, mel_dim)
+        return tf.math.log(mel_spectrograms + 1e-6)
+        #
+    def call(self, waves):
+        # waves is (batch, samples) floats, or a RaggedTensor of them, in which case this returns the
+        # padded logmels (batch, frames, mel_dim) and their lengths (batch,), as the pipeline would,
+        # with frames cut to the longest length as batch_transform() cuts them
+        if isinstance(waves, tf.RaggedTensor):
+            lengths = wave_frames(tf.cast(waves.row_lengths(), tf.int32))
+            logmels = self.logmels(waves.to_tensor())
+            return logmels[:, :tf.reduce_max(lengths), :], lengths
+        return self.logmels(waves)
+        #
+    def get_config(self):
+        config = super(LogMelFrontend, self).get_config()
+        config.update({'mel_dim' : self.mel_dim, 'sample_rate' : self.sample_rate})
+        return config
+
+
+frontend = LogMelFrontend(mel_dim, sample_rate)
+
+
+# waveform tensor, shape (..., samples) -> log mel spectrograms, shape (..., frames, mel_dim)
 def get_spectrogram(wt):
-    """Adapted from help(tf.signal.mfccs_from_log_mel_spectrograms)
-    inputs  : waveform tensor, shape (..., samples) with floating point values in [-1, 1]
-    returns : log mel spectrograms, shape (..., frames, mel_dim) as float32s
-              ... means the batch dimension is optional
-    """
-    #
-    # These have to be tf.constant because if I just do the calculations in Python then tf complains:
-    # "ValueError: Creating variables on a non-first call to a function decorated with tf.function."
-    frame_length = tf.constant(sample_rate * 25 // 1000)
-    frame_step   = tf.constant(sample_rate * 10 // 1000)
-    # 
-    # produces shape (..., frames, fftbins)
-    stfts = tf.signal.stft(wt, frame_length, frame_step)
-    spectrograms = tf.abs(stfts)
-    #
-    # Warp the linear scale spectrograms into the mel-scale.
-    num_spectrogram_bins = stfts.shape[-1]
-    lower_edge_hertz, upper_edge_hertz, num_mel_bins = 80.0, 7600.0, mel_dim
-    linear_to_mel_weight_matrix = tf.signal.linear_to_mel_weight_matrix(
-      num_mel_bins, num_spectrogram_bins, sample_rate, lower_edge_hertz,
-      upper_edge_hertz)
-    mel_spectrograms = tf.tensordot(
-      spectrograms, linear_to_mel_weight_matrix, 1)
-    mel_spectrograms.set_shape(spectrograms.shape[:-1].concatenate(
-      linear_to_mel_weight_matrix.shape[-1:]))
-    #
-    # Compute a stabilized log to get log-magnitude mel-scale spectrograms.
-    log_mel_spectrograms = tf.math.log(mel_spectrograms + 1e-6)
-    #
-    # return shape (..., frames, mel_dim)
-    return log_mel_spectrograms
-
-
-# map function to convert the Librispeech Dataset dictionary into {logmels, speaker_id, ygt}
+    return frontend.logmels(wt)
+
+
+# Convert a waveform of int samples (or augmented floats) into logmels; the speech half of transform(),
+# shared with the feature cache.
 @tf.autograph.experimental.do_not_convert
-def transform(d):
-    wi = d['speech']         # -> (samples)
-    wf = tf.cast(wi, dtype=tf.float32)
-    wf = wf / 32768.0
+def speech_to_logmels(wi):
+    wf = wave_to_float(wi)
     sf = get_spectrogram(wf) # -> (frames, mel_dim)
     nf = tf.shape(sf)[0]     # number of frames
     pd = 2 ** lis_layers     # pyramid downsampling due to listener layers
     nh = nf // pd            # number of hidden representations after pyramid downsampling
     nf = nh * pd             # number of original frames that will be used
     sp = sf[:nf,:]           # spectrogram of these frames only, shape (frames, mel_dim)
-    t  = d['text']           # -> () with dtype=tf.string
+    return sp
+
+
+# The Vocabulary maps characters to dense ids and back.  Only the voc_dim characters in the vocabulary
+# are ever produced, so the 1-hot inputs, pyp state and softmax are voc_dim wide, and not 123 wide as
+# they would be if characters were represented by their unicode code points.
+# The conversions are done with gathers from small constant tensors, so they work anywhere in a graph.
+class Vocabulary():
+    def __init__(self, chars):
+        # the characters, in id order
+        self.chars  = chars
+        self.size   = len(chars)
+        # ids of the special tokens
+        self.unk_id = chars.index('?')
+        self.sos_id = chars.index('^')
+        self.eos_id = chars.index('$')
+        # id -> code point
+        codes = [ord(c) for c in chars]
+        self.code_points = tf.constant(codes, dtype=tf.int32)
+        # code point -> id, for all code points up to the highest in the vocabulary; others are <unk>
+        ids = np.full(max(codes) + 2, self.unk_id, dtype=np.int32)
+        ids[codes] = np.arange(self.size)
+        self.ids = tf.constant(ids)
+        #
+    def encode(self, text):
+        # text shape () tf.string -> (nchars,) int32 ids
+        cps = tf.strings.unicode_decode(text, 'utf-8', replacement_char=ord('?'))
+        cps = tf.clip_by_value(cps, 0, tf.shape(self.ids)[0] - 1)
+        return tf.gather(self.ids, cps)
+        #
+    def decode(self, ids):
+        # ids shape (..., nchars) int32 -> (...) tf.string
+        return tf.strings.unicode_encode(tf.gather(self.code_points, ids), 'UTF-8', replacement_char=63)
+
+
+vocab = Vocabulary(voc_chars)
+
+
+# Convert a transcript into character ids; the text half of transform(), shared with the feature cache.
+@tf.autograph.experimental.do_not_convert
+def text_to_ygt(t):
+    # t has shape () with dtype=tf.string
     # permitted characters are {a,b,c...,z,0,...,9,<space>,<comma>,<period>,<apostrophe>,<unk>}
     # The unknown token I use is ?
     l  = tf.strings.lower(t)
@@ -183,64 +389,598 @@ def transform(d):
     p1 = tf.strings.join([b'^', r])
     # postfix the text with the <eos> token, for which I use $
     p2 = tf.strings.join([p1, b'$'])
-    # Decode the text into numbers, using '?' (63) for any unknown conversions (unlikely).
-    # The vocabulary above therefore spans values 32 (space) to 122 (z).
-    ysp = tf.strings.unicode_decode(p2,'utf-8', replacement_char=63) # -> (nchars, )
-    # To be used in neural networks the decoded values must be 1-hot encoded
-    yoh = tf.one_hot(ysp, voc_dim) # -> (nchars, voc_dim) as float32s
+    # Encode the text into vocabulary ids, using '?' for any unknown conversions (unlikely).
+    ysp = vocab.encode(p2) # -> (nchars, ) as int32s
+    # The ids stay sparse all the way to the model, which 1-hot encodes its inputs itself.
+    # (Dense 1-hot ygt tensors were voc_dim times bigger to shuffle, pad, batch and copy to the GPU.)
+    return ysp
+
+
+# map function to convert the Librispeech Dataset dictionary into
+# {logmels, logmel_len, speaker_id, ygt, ygt_len}, where the lengths are the numbers of frames and chars
+@tf.autograph.experimental.do_not_convert
+def transform(d):
+    sp  = speech_to_logmels(d['speech']) # -> (frames, mel_dim)
+    ysp = text_to_ygt(d['text'])         # -> (nchars,)
     # this function returns a dictionary; gt means ground truth
-    o = {'logmels' : sp, 'speaker_id' : d['speaker_id'], 'ygt' : yoh}
+    o = {'logmels' : sp,  'logmel_len' : tf.shape(sp)[0],  'speaker_id' : d['speaker_id'],
+         'ygt'     : ysp, 'ygt_len'    : tf.shape(ysp)[0]}
     return o
 
 
-# convert the Librispeech elements into {logmels, speaker_id, ygt}
-logm_ds = waug_ds.map(transform)
+# The feature cache stores the (unaugmented) logmels of every filtered training utterance as float16s in
+# one flat memory-mapped file, plus an index of (offset, frames, speaker_id, text) for each utterance.
+# STFTs then only need to be computed once, rather than on every epoch of every run.
+# Waveform augmentation cannot be applied to cached logmels, so use_cache trains with logmel_augment
+# (aug_mode 'logmel') or without augmentation.
+#
+# The cache lives in a subdirectory named after everything that determines its contents, so changing
+# any front-end parameter (or the length filter) automatically selects, and if necessary builds, a new one.
+def feature_cache_path(split):
+    frame_length = sample_rate * 25 // 1000
+    frame_step   = sample_rate * 10 // 1000
+    key = (f'mel{mel_dim}_sr{sample_rate}_fl{frame_length}_fs{frame_step}'
+           f'_pd{2 ** lis_layers}_mf{max_frames}_mc{min(max_chars, 300)}')
+    return os.path.join(cache_dir, split, key)
+
+
+# Build the feature cache from a dataset of filtered Librispeech dictionaries.
+# The index is written last, so a cache is only complete (and usable) once index.npz exists.
+def build_feature_cache(ds, path):
+    os.makedirs(path, exist_ok=True)
+    offsets, frames, speaker_ids, texts = [], [], [], []
+    offset = 0
+    lm_ds  = ds.map(lambda d: (speech_to_logmels(d['speech']), d['speaker_id'], d['text']),
+                    num_parallel_calls=num_parallel).prefetch(prefetch_num)
+    with open(os.path.join(path, 'logmels.f16'), 'wb') as f:
+        for sp, sid, t in lm_ds:
+            sp = sp.numpy().astype(np.float16)  # (frames, mel_dim)
+            f.write(sp.tobytes())
+            offsets.append(offset)
+            frames.append(sp.shape[0])
+            speaker_ids.append(sid.numpy())
+            texts.append(t.numpy())
+            offset += sp.shape[0]
+    np.savez(os.path.join(path, 'index.npz'),
+             offset     = np.array(offsets,     dtype=np.int64),
+             frames     = np.array(frames,      dtype=np.int64),
+             speaker_id = np.array(speaker_ids, dtype=np.int64),
+             text       = np.array(texts))
+
+
+# Make a dataset of the entries of an index, a dictionary of equal length arrays (one element per utterance).
+# With shuffle the entries come in a new random order every epoch.  Only the integer positions of the
+# entries are shuffled, before anything is read, so the shuffle buffer holds just one int64 per utterance
+# and resident memory stays flat however big the corpus is.
+def index_dataset(index, shuffle=False):
+    fields = {k : tf.constant(v) for k, v in index.items()}
+    n      = len(next(iter(index.values())))
+    ids    = tf.data.Dataset.range(n)
+    if shuffle:
+        ids = ids.shuffle(n, reshuffle_each_iteration=True, seed=1)
+    return ids.map(lambda i: {k : tf.gather(v, i) for k, v in fields.items()})
+
+
+# Read the feature cache back as a dataset of dictionaries like those from transform().
+# Shuffling is done on the index entries, before any logmels are read.
+def feature_cache_dataset(path, shuffle=False, num_parallel=None):
+    index   = np.load(os.path.join(path, 'index.npz'))
+    # memory map the logmels as (total_frames, mel_dim) float16s; slices of this are read on demand
+    logmels = np.memmap(os.path.join(path, 'logmels.f16'), dtype=np.float16, mode='r').reshape(-1, mel_dim)
+    #
+    def read_logmels(offset, frames):
+        return logmels[offset:offset + frames]
+    #
+    @tf.autograph.experimental.do_not_convert
+    def read_cached(d):
+        sp = tf.numpy_function(read_logmels, [d['offset'], d['frames']], tf.float16)
+        sp = tf.cast(tf.reshape(sp, (-1, mel_dim)), tf.float32) # (frames, mel_dim)
+        ys = text_to_ygt(d['text'])                              # (nchars,)
+        o  = {'logmels' : sp, 'logmel_len' : tf.shape(sp)[0], 'speaker_id' : d['speaker_id'],
+              'ygt'     : ys, 'ygt_len'    : tf.shape(ys)[0]}
+        return o
+    #
+    ids = index_dataset({k : index[k] for k in index.files}, shuffle=shuffle)
+    return ids.map(read_cached, num_parallel_calls=num_parallel)
+
+
+# The audio corpus stores every waveform of a split as int16s in one flat memory-mapped file, plus an
+# index of (offset, samples, chars, speaker_id, text) for each utterance.  It's converted once from the
+# tfds split, and after that waveforms are read as slices of the memory map, so the I/O can be tuned like
+# any other file's.  The index holds each utterance's length in samples and characters, so utterances
+# are filtered, sharded and (with vec_frontend) bucketed from the index alone, before any audio is read.
+# The corpus holds every utterance, so changing the length filter doesn't need a new one.
+def corpus_path(split):
+    return os.path.join(corpus_dir, split)
+
+
+# Build the audio corpus from a dataset of (unfiltered) Librispeech dictionaries.
+# The index is written last, so a corpus is only complete (and usable) once index.npz exists.
+def build_corpus(ds, path):
+    os.makedirs(path, exist_ok=True)
+    offsets, samples, chars, speaker_ids, texts = [], [], [], [], []
+    offset = 0
+    with open(os.path.join(path, 'samples.i16'), 'wb') as f:
+        for d in ds.prefetch(prefetch_num):
+            wi = d['speech'].numpy().astype(np.int16)  # (samples,)
+            t  = d['text'].numpy()
+            f.write(wi.tobytes())
+            offsets.append(offset)
+            samples.append(wi.shape[0])
+            chars.append(len(t))                       # bytes, as tf.strings.length counts them
+            speaker_ids.append(d['speaker_id'].numpy())
+            texts.append(t)
+            offset += wi.shape[0]
+    np.savez(os.path.join(path, 'index.npz'),
+             offset     = np.array(offsets,     dtype=np.int64),
+             samples    = np.array(samples,     dtype=np.int64),
+             chars      = np.array(chars,       dtype=np.int64),
+             speaker_id = np.array(speaker_ids, dtype=np.int64),
+             text       = np.array(texts))
+
+
+# The length filter of filter_lengths(), applied to a corpus index rather than to decoded utterances.
+def filter_index(index):
+    keep = ((index['samples'] <= max_frames * sample_rate // 100) &
+            (index['chars']   <= min(max_chars, 300)))
+    return {k : v[keep] for k, v in index.items()}
+
+
+# Open the audio corpus in path, returning a dataset of its filtered index entries (the shard_index'th
+# of num_shards equal shards of them) and a function to read the samples of either one entry, or a
+# batch of entries, which are padded with 0s.  Shuffling is done on the index entries.
+def open_corpus(path, shuffle=False, num_shards=1, shard_index=0):
+    index   = np.load(os.path.join(path, 'index.npz'))
+    index   = filter_index({k : index[k] for k in index.files})
+    index   = {k : v[shard_index::num_shards] for k, v in index.items()}
+    # memory map the samples as int16s; slices of this are read on demand
+    samples = np.memmap(os.path.join(path, 'samples.i16'), dtype=np.int16, mode='r')
+    #
+    def read_samples(offset, nsamples):
+        if np.ndim(offset) == 0:
+            return samples[offset:offset + nsamples]
+        wb = np.zeros((len(offset), np.max(nsamples, initial=0)), dtype=np.int16)
+        for i, (o, n) in enumerate(zip(offset, nsamples)):
+            wb[i, :n] = samples[o:o + n]
+        return wb
+    #
+    return index_dataset(index, shuffle=shuffle), read_samples
+
+
+# Read the audio corpus back as a dataset of Librispeech dictionaries, with int16 speech.
+def corpus_dataset(path, shuffle=False, num_parallel=None, num_shards=1, shard_index=0):
+    ids, read_samples = open_corpus(path, shuffle, num_shards, shard_index)
+    #
+    @tf.autograph.experimental.do_not_convert
+    def read_corpus(d):
+        wi = tf.numpy_function(read_samples, [d['offset'], d['samples']], tf.int16)
+        wi = tf.reshape(wi, (-1,))   # (samples,)
+        return {'speech' : wi, 'speaker_id' : d['speaker_id'], 'text' : d['text']}
+    #
+    return ids.map(read_corpus, num_parallel_calls=num_parallel)
+
 
+# the padded shapes of the corpus index entries batched by corpus_wave_batches()
+index_shapes = {'offset'     : (), 'speech_len' : (), 'logmel_len' : (), 'speaker_id' : (),
+                'ygt'        : (None,), 'ygt_len' : ()}
 
-# The Normalization layer computes and stores means and variances for each logmel dimension.
-# Processing all of train_clean100 (~28,000 examples) takes a long time.
-# However, the mean and variance vectors don't change much after 100 examples.
-# The number to process is chosen with the training parameter norm_count.
 
-print('Computing data normalization vectors...')
-norm = preprocessing.Normalization(axis=-1)
-norm.adapt(logm_ds.take(norm_count).map(lambda d: d['logmels']))
+# Read the audio corpus as batches of prepare_wave() dictionaries for vec_frontend.  The index entries
+# are batched by batched(ds, shapes), which buckets them on their lengths, and only then is each whole
+# batch of waveforms read, so the bucketing buffers hold index entries rather than audio.
+def corpus_wave_batches(path, batched, shuffle=False, num_parallel=None, num_shards=1, shard_index=0):
+    ids, read_samples = open_corpus(path, shuffle, num_shards, shard_index)
+    #
+    @tf.autograph.experimental.do_not_convert
+    def index_to_wave(d):
+        nsamp = tf.cast(d['samples'], tf.int32)
+        ysp   = text_to_ygt(d['text'])
+        return {'offset'     : d['offset'], 'speech_len' : nsamp, 'logmel_len' : wave_frames(nsamp),
+                'speaker_id' : d['speaker_id'], 'ygt' : ysp, 'ygt_len' : tf.shape(ysp)[0]}
+    #
+    @tf.autograph.experimental.do_not_convert
+    def read_batch(d):
+        wb = tf.numpy_function(read_samples, [d['offset'], d['speech_len']], tf.int16)
+        d['speech'] = tf.reshape(wb, (tf.shape(d['offset'])[0], -1))   # (batch, samples)
+        return d
+    #
+    pds = batched(ids.map(index_to_wave, num_parallel_calls=num_parallel), index_shapes)
+    return pds.map(read_batch, num_parallel_calls=num_parallel)
+
 
-# normalize the logmels to have 0 mean and stdev 1 in each dimension
+# The normalization statistics are computed exactly, over every frame of a dataset of logmels.
+# Each utterance's (count, mean, M2) statistics are computed in a parallel map, so all the cores work
+# on the logmels, and the utterance statistics are then merged into running totals with Chan et al's
+# pairwise update, a numerically stable generalisation of Welford's streaming algorithm.
+# M2 is the sum of squared differences from the mean, so the variance is M2 / count.
 @tf.autograph.experimental.do_not_convert
-def normalize(d):
-    logmels = norm(d['logmels'])
-    o = {'logmels' : logmels, 'speaker_id' : d['speaker_id'], 'ygt' : d['ygt']}
-    return o
+def logmel_stats(d):
+    x    = tf.cast(d['logmels'], tf.float64)             # (frames, mel_dim)
+    n    = tf.cast(tf.shape(x)[0], tf.float64)           # ()
+    mean = tf.math.divide_no_nan(tf.reduce_sum(x, axis=0), n)
+    m2   = tf.reduce_sum(tf.square(x - mean), axis=0)    # (mel_dim,)
+    return n, mean, m2
 
 
-norm_ds = logm_ds.map(normalize)
+@tf.autograph.experimental.do_not_convert
+def chan_merge(a, b):
+    na, meana, m2a = a
+    nb, meanb, m2b = b
+    n     = na + nb
+    delta = meanb - meana
+    mean  = meana + delta * tf.math.divide_no_nan(nb, n)
+    m2    = m2a + m2b + tf.square(delta) * tf.math.divide_no_nan(na * nb, n)
+    return n, mean, m2
+
+
+def compute_norm_stats(ds, path, num_parallel=num_parallel):
+    init = (tf.constant(0.0, tf.float64), tf.zeros(mel_dim, tf.float64), tf.zeros(mel_dim, tf.float64))
+    n, mean, m2 = ds.map(logmel_stats, num_parallel_calls=num_parallel).reduce(init, chan_merge)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, count=n.numpy(), mean=mean.numpy(), variance=(m2 / n).numpy())
+
+
+# returns the mean and standard deviation as float32 constants, ready for LASModel.set_norm_stats()
+def load_norm_stats(path):
+    stats = np.load(path)
+    mean  = tf.constant(stats['mean'],                dtype=tf.float32)
+    std   = tf.constant(np.sqrt(stats['variance']), dtype=tf.float32)
+    return mean, tf.maximum(std, keras.backend.epsilon())
+
+
+# map function to augment logmels (from transform() or the feature cache) with cheap approximations of
+# what wav_augment does to the waveform, plus SpecAugment style masking, so that augmented training can
+# reuse logmels computed just once.  The front end then runs once per utterance instead of once per epoch.
+@tf.autograph.experimental.do_not_convert
+def logmel_augment(d):
+    seed  = d.pop('aug_seed')                   # (2,)
+    x     = d['logmels']                        # (frames, mel_dim)
+    pd    = 2 ** lis_layers
+    floor = tf.math.log(1e-6)                   # the logmel of silence
+    # wav_augment's shift of up to max_shift samples is a shift of up to pd frames, filled with silence,
+    # after which the frames are again truncated to a multiple of pd
+    shift = tf.random.stateless_uniform([], draw_seed(seed, 0), minval=0, maxval=pd, dtype=tf.int32)
+    nf    = (tf.shape(x)[0] + shift) // pd * pd
+    x     = tf.pad(x, [[shift, 0], [0, 0]], constant_values=floor)[:nf]
+    # wav_augment multiplies the waveform by scale + noisescale * whitenoise.  Its mean, scale + noisescale/2,
+    # is a gain, which is a log offset, and its fluctuation (whose stdev is noisescale/sqrt(12)) spreads
+    # some of the energy of each frame over all frequencies, which is approximated by adding a noise floor
+    # proportional to each frame's mean mel magnitude.
+    scale      = tf.random.stateless_uniform([], draw_seed(seed, 1), minval=0.8, maxval=1.0)
+    noisescale = tf.random.stateless_uniform([], draw_seed(seed, 2), minval=0,   maxval=1.0) * (1.0 - scale)
+    mel   = tf.maximum(tf.exp(x) - 1e-6, 0.0)   # mel magnitudes
+    noise = noisescale / np.sqrt(12.0) * tf.reduce_mean(mel, axis=-1, keepdims=True)
+    x     = tf.math.log(mel * (scale + noisescale / 2) + noise + 1e-6)
+    # mask one band of up to time_mask frames and one of up to freq_mask logmels with the utterance mean
+    tw    = tf.minimum(tf.random.stateless_uniform([], draw_seed(seed, 3), minval=0, maxval=time_mask + 1,
+                                                   dtype=tf.int32), nf)
+    t0    = tf.random.stateless_uniform([], draw_seed(seed, 4), minval=0, maxval=nf - tw + 1, dtype=tf.int32)
+    fw    = tf.random.stateless_uniform([], draw_seed(seed, 5), minval=0, maxval=freq_mask + 1, dtype=tf.int32)
+    f0    = tf.random.stateless_uniform([], draw_seed(seed, 6), minval=0, maxval=mel_dim - fw + 1, dtype=tf.int32)
+    t     = tf.range(nf)[:, None]
+    f     = tf.range(mel_dim)[None, :]
+    band  = tf.logical_or(tf.logical_and(t >= t0, t < t0 + tw), tf.logical_and(f >= f0, f < f0 + fw))
+    x     = tf.where(band, tf.reduce_mean(x, axis=0, keepdims=True), x)
+    d['logmels']    = x
+    d['logmel_len'] = nf
+    return d
+
 
+# the padded shapes of the transform() dictionaries when batched
+padded_shapes = {'logmels' : (None, mel_dim), 'logmel_len' : (), 'speaker_id' : (),
+                 'ygt'     : (None,),         'ygt_len'    : ()}
 
-# padded_batch pads all arrays with 0s to make rectangular tensors
-padd_ds = norm_ds.padded_batch(
-    batch_size,
-    padded_shapes=({'logmels' : (None, mel_dim), 'speaker_id' : (), 'ygt' : (None, voc_dim)}))
+
+# padded_batch pads all arrays with 0s to make rectangular tensors.
+# Batching utterances of anything from 1s to 17s together means most of the listener and decoder RNN time
+# is spent on padding, so instead examples are grouped into buckets of similar length before padding.
+# An example's bucket is determined by the number of bucket_frames boundaries its frame count exceeds
+# and, if bucket_chars is not empty, by the number of bucket_chars boundaries its character count exceeds.
+# Each bucket is batched separately, using the bucket_sizes batch size of its frame bucket.
+# With empty bucket_frames and bucket_chars there's only one bucket, equivalent to plain padded_batch.
+#
+# Alternatively, given a budget, each bucket's batch size is the number of its longest possible examples
+# whose frames x chars product fits in the budget.  Short examples then go in big batches and long
+# examples in small batches, while the memory needed by the largest batch stays bounded.
+#
+# The examples' padded shapes are given by shapes.
+def bucket_batch(ds, bucket_frames, bucket_sizes, bucket_chars=(), budget=0, shapes=padded_shapes):
+    assert len(bucket_sizes) == len(bucket_frames) + 1, "bucket_sizes needs one more entry than bucket_frames"
+    num_cb = len(bucket_chars) + 1    # number of character buckets in each frame bucket
+    if budget > 0:
+        # upper frame and character limits of each bucket, the last ones being the filter_lengths limits
+        frame_tops = list(bucket_frames) + [max_frames]
+        char_tops  = list(bucket_chars)  + [min(max_chars, 300) + 2]  # + 2 for <sos> and <eos>
+        key_sizes  = [max(1, budget // (ft * ct)) for ft in frame_tops for ct in char_tops]
+    else:
+        key_sizes  = [bs for bs in bucket_sizes for _ in range(num_cb)]
+    frame_bounds = tf.constant(list(bucket_frames), dtype=tf.int64)
+    char_bounds  = tf.constant(list(bucket_chars),  dtype=tf.int64)
+    batch_sizes  = tf.constant(key_sizes,           dtype=tf.int64)
+    #
+    @tf.autograph.experimental.do_not_convert
+    def key_func(d):
+        nf = tf.cast(d['logmel_len'], tf.int64)
+        nc = tf.cast(d['ygt_len'], tf.int64)
+        fb = tf.reduce_sum(tf.cast(nf > frame_bounds, tf.int64))
+        cb = tf.reduce_sum(tf.cast(nc > char_bounds,  tf.int64))
+        return fb * num_cb + cb
+    #
+    @tf.autograph.experimental.do_not_convert
+    def window_size_func(key):
+        return batch_sizes[key]
+    #
+    @tf.autograph.experimental.do_not_convert
+    def reduce_func(key, window):
+        return window.padded_batch(window_size_func(key), padded_shapes=shapes)
+    #
+    return ds.apply(tf.data.experimental.group_by_window(
+        key_func, reduce_func, window_size_func=window_size_func))
 
 
 # map function to add logmel and character masks to the training dataset
+# The masks are made from the lengths, which is cheaper than examining the padded data itself, and
+# can't mistake a real frame for padding just because its normalized logmels happen to sum to 0.
 @tf.autograph.experimental.do_not_convert
 def gen_masks(d):
     logmels = d['logmels']  # (batch, frames, mel_dim)
-    # create a logmel mask where False indicates a padded value (0s in every logmel dimension)
-    logmel_mask = tf.cast(tf.reduce_sum(logmels, axis=-1), tf.bool)  # (batch, frames)
+    # create a logmel mask where False indicates a padded value
+    logmel_mask = tf.sequence_mask(d['logmel_len'], maxlen=tf.shape(logmels)[1])  # (batch, frames)
     # add to the dictionary
     d['logmel_mask'] = logmel_mask
     # extract the ground truth y values
-    ygt = d['ygt']  # (batch, nchars, voc_dim)
+    ygt = d['ygt']  # (batch, nchars)
     # create a ground truth mask where False indicates a padded value
-    ygt_mask = tf.cast(tf.reduce_sum(ygt, axis=-1), tf.bool)  # (batch, nchars)
+    ygt_mask = tf.sequence_mask(d['ygt_len'], maxlen=tf.shape(ygt)[1])  # (batch, nchars)
     # add to the dictionary
     d['ygt_mask'] = ygt_mask
     return d
 
 
-mask_ds = padd_ds.map(gen_masks)
+# The training pipeline can be run on a local tf.data service, so that the preprocessing is spread over
+# worker processes, each with its own cores and Python interpreter, instead of competing with train_step
+# for this one.  The dispatcher runs in this process and num_workers worker processes are started on the
+# same machine (and killed when this process exits); they are generic tf.data workers, because the
+# dispatcher sends them the pipeline graph to run, and they're kept off the GPU.  The pipeline graph
+# can't contain Python functions, so this works with the tfds source but not the audio corpus or the
+# feature cache, which read their memory maps through tf.numpy_function.  DispatcherConfig, WorkerConfig
+# and distributed_epoch processing all need TensorFlow 2.4.
+def start_data_service(num_workers, port=svc_port):
+    tf_version = tuple(int(v) for v in tf.__version__.split('.')[:2])
+    assert tf_version >= (2, 4), 'the tf.data service needs TensorFlow 2.4 or later, not ' + tf.__version__
+    dispatcher = tf.data.experimental.service.DispatchServer(
+        tf.data.experimental.service.DispatcherConfig(port=port))
+    address    = dispatcher.target.split('://')[1]
+    script     = ('import tensorflow as tf\n'
+                  'cfg = tf.data.experimental.service.WorkerConfig(dispatcher_address=%r)\n'
+                  'tf.data.experimental.service.WorkerServer(cfg).join()\n' % address)
+    env        = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    workers    = [subprocess.Popen([sys.executable, '-c', script], env=env) for _ in range(num_workers)]
+    atexit.register(lambda: [w.kill() for w in workers])
+    return dispatcher, workers
+
+
+# Build an input pipeline from a split of Librispeech dictionaries, applying in order:
+# filter_lengths, shuffle, wav_augment, transform (or the feature cache), logmel_augment, batching and gen_masks.
+# The logmels are not normalized here; the model does that itself, see LASModel.listen().
+#   shuffle     : shuffle examples every epoch (for training)
+#   augment     : apply wav_augment, or with aug_mode 'logmel' or a cache_split logmel_augment
+#   batch       : None for unbatched examples, 'buckets' for bucket_batch(), or a padded_batch batch size
+#   corpus_split: if not None, read waveforms from this split's audio corpus (built from ds if needed)
+#   cache_split : if not None, read unaugmented logmels from this split's feature cache, building it if needed
+#   vec_frontend: batch the waveforms before augmenting and transforming them a batch at a time
+#   num_shards  : with corpus_split, use only the shard_index'th of num_shards equal shards of the split
+#   service     : if not None, the target of a tf.data service dispatcher to run the pipeline on
+#                 Its workers share each epoch, so every example is still used once per epoch.
+#                 It can't be combined with corpus_split or cache_split, see start_data_service().
+# Every map function runs num_parallel calls at a time and the output is prefetched prefetch_num elements
+# ahead, so preprocessing keeps all the cores busy while the model trains.  With ordered False tf.data
+# may return elements out of order rather than wait for a slow one, and a ram_budget > 0 caps the
+# memory that autotuning may give to buffers.
+def build_pipeline(ds, shuffle=False, augment=False, batch='buckets', corpus_split=None,
+                   cache_split=None, vec_frontend=vec_frontend, num_shards=1, shard_index=0, service=None,
+                   num_parallel=num_parallel, prefetch_num=prefetch_num, ordered=ordered, ram_budget=ram_budget):
+    assert service is None or (corpus_split is None and cache_split is None), \
+        "the tf.data service can't run the audio corpus or feature cache, which use tf.numpy_function"
+    # batch the examples of pds, whose padded shapes are shapes
+    def batched(pds, shapes):
+        if batch == 'buckets':
+            return bucket_batch(pds, bkt_frames, bkt_sizes, bkt_chars, bkt_budget, shapes)
+        return pds.padded_batch(batch, padded_shapes=shapes)
+    #
+    # The feature cache holds logmels, so there are no waveforms to augment and it uses logmel_augment.
+    logmel_aug   = augment and (aug_mode == 'logmel' or cache_split is not None)
+    wave_aug     = augment and not logmel_aug
+    wave_batches = vec_frontend and batch is not None and cache_split is None and not logmel_aug
+    is_batched   = False
+    if corpus_split is not None:
+        path = corpus_path(corpus_split)
+        if not os.path.exists(os.path.join(path, 'index.npz')):
+            print('Building audio corpus in', path)
+            build_corpus(ds, path)
+        # The corpus is filtered, sharded and shuffled (unless the feature cache will shuffle) on its index.
+        # With vec_frontend the index entries are bucketed too, before their audio is read.
+        if wave_batches:
+            pds = corpus_wave_batches(path, batched, shuffle=shuffle, num_parallel=num_parallel,
+                                      num_shards=num_shards, shard_index=shard_index)
+            is_batched = True
+        else:
+            pds = corpus_dataset(path, shuffle=shuffle and cache_split is None, num_parallel=num_parallel,
+                                 num_shards=num_shards, shard_index=shard_index)
+    else:
+        pds = ds.filter(filter_lengths)
+    if cache_split is not None:
+        cache_path = feature_cache_path(cache_split)
+        if not os.path.exists(os.path.join(cache_path, 'index.npz')):
+            print('Building feature cache in', cache_path)
+            build_feature_cache(pds, cache_path)
+        pds = feature_cache_dataset(cache_path, shuffle=shuffle, num_parallel=num_parallel)
+    else:
+        if corpus_split is None:
+            pds = pds.map(to_int16, num_parallel_calls=num_parallel)
+        if shuffle and corpus_split is None:
+            # A shuffle buffer of 2048 whole int64 waveforms added about 4GB to the resident memory size.
+            # Instead there are two levels of shuffling: the tfds files are read in a new order each
+            # epoch (shuffle_files, which permutes them before anything is read), read_cycle at a time
+            # and one utterance from each in turn, and then examples are shuffled within a window of
+            # shuf_window int16 waveforms (about 100MB for 256), whose memory use doesn't grow with the
+            # size of the corpus.  This is not a permutation of the utterances: utterances near each
+            # other in a file stay near each other in every epoch.  Sources with an index (the audio
+            # corpus or feature cache) get a full permutation of the utterances from index_dataset().
+            pds = pds.shuffle(shuf_window, reshuffle_each_iteration=True, seed=1)
+        if wave_batches:
+            if not is_batched:
+                pds = batched(pds.map(prepare_wave, num_parallel_calls=num_parallel), wave_shapes)
+                is_batched = True
+            if wave_aug:
+                pds = add_aug_seeds(pds).map(batch_wav_augment, num_parallel_calls=num_parallel)
+            pds = pds.map(batch_transform, num_parallel_calls=num_parallel)
+        else:
+            if wave_aug:
+                pds = add_aug_seeds(pds).map(wav_augment, num_parallel_calls=num_parallel)
+            pds = pds.map(transform, num_parallel_calls=num_parallel)
+    if logmel_aug:
+        pds = add_aug_seeds(pds).map(logmel_augment, num_parallel_calls=num_parallel)
+    if batch is not None:
+        if not is_batched:
+            pds = batched(pds, padded_shapes)
+        pds = pds.map(gen_masks, num_parallel_calls=num_parallel)
+    options = tf.data.Options()
+    options.experimental_deterministic = ordered
+    if ram_budget > 0:
+        # TF 2.6 moved the option from experimental_optimization.autotune_ram_budget to autotune.ram_budget
+        if hasattr(options, 'autotune'):
+            options.autotune.ram_budget = ram_budget
+        else:
+            options.experimental_optimization.autotune_ram_budget = ram_budget
+    # The only state outside the pipeline is the memory maps read by tf.numpy_function, which are read-only,
+    # so the iterator can be checkpointed without it.
+    options.experimental_external_state_policy = tf.data.experimental.ExternalStatePolicy.IGNORE
+    pds = pds.with_options(options)
+    if service is not None:
+        pds = pds.apply(tf.data.experimental.service.distribute(processing_mode='distributed_epoch',
+                                                                service=service))
+    return pds.prefetch(prefetch_num)
+
+
+# With use_cache the training logmels are computed (once) from unaugmented speech and read back from the cache.
+train_cache = 'train_clean100' if use_cache else None
+# With use_corpus the waveforms are converted (once) into the audio corpus and read back from there.
+train_corp  = 'train_clean100' if use_corpus else None
+dev_corp    = 'dev_clean'      if use_corpus else None
+
+
+# Check the tf.data service on localhost, with num_workers workers.  A range pipeline, with the seeds of
+# add_aug_seeds() zipped in, must come back with every element exactly once and distinct seeds, which
+# shows distributed_epoch splits the seeds' range between the workers as well as the data, so that no two
+# workers augment with the same seeds.  Then num_batches batches of the training pipeline are read
+# through the service.
+def smoke_test_service(ds, num_workers=2, num_elems=1000, num_batches=2):
+    dispatcher, workers = start_data_service(num_workers)
+    distribute = tf.data.experimental.service.distribute(processing_mode='distributed_epoch',
+                                                         service=dispatcher.target)
+    rds   = add_aug_seeds(tf.data.Dataset.range(num_elems).map(lambda x: {'x': x})).apply(distribute)
+    elems = [(int(d['x']), tuple(d['aug_seed'].numpy())) for d in rds]
+    assert sorted(x for x, _ in elems) == list(range(num_elems)), 'the service lost or repeated elements'
+    assert len(set(s for _, s in elems)) == num_elems, 'the service repeated augmentation seeds'
+    print(f'range pipeline OK on {num_workers} workers')
+    mask_ds = build_pipeline(ds, shuffle=True, augment=True, service=dispatcher.target)
+    for d in mask_ds.take(num_batches):
+        print('training pipeline batch OK', {k: tuple(v.shape) for k, v in d.items()})
+
+
+if svc_smoke:
+    smoke_test_service(train_ds)
+    print('tf.data service smoke test done')
+    raise SystemExit(0)
+
+
+# Benchmark the input pipeline stage by stage, on the first num_utts utterances of ds, to find which stage
+# is the bottleneck and to catch regressions.  Each stage is timed in isolation, reading its input from an
+# in-memory copy of the output of the stages before it, and cumulatively, as the pipeline up to and
+# including it.  The report gives elements (utterances or batches) per second, seconds of (filtered) audio
+# per second, the total size of the tensors the stage outputs (which is not the memory it allocates), and
+# the current resident memory of the process after the pass, and how much it grew during the pass.
+# ds should read its files in a fixed order (shuffle_files=False), so every pass sees the same utterances.
+def benchmark_pipeline(ds, num_utts=bench_utts, num_parallel=num_parallel):
+    stages = [('read',           lambda pds: pds),
+              ('filter_lengths', lambda pds: pds.filter(filter_lengths)),
+              ('to_int16',       lambda pds: pds.map(to_int16,    num_parallel_calls=num_parallel)),
+              ('shuffle',        lambda pds: pds.shuffle(shuf_window, seed=1)),
+              ('wav_augment',    lambda pds: add_aug_seeds(pds).map(wav_augment, num_parallel_calls=num_parallel)),
+              ('transform',      lambda pds: pds.map(transform,   num_parallel_calls=num_parallel)),
+              ('padded_batch',   lambda pds: pds.padded_batch(batch_size, padded_shapes=padded_shapes)),
+              ('gen_masks',      lambda pds: pds.map(gen_masks,   num_parallel_calls=num_parallel))]
+    src   = ds.take(num_utts)
+    audio = sum(int(tf.shape(d['speech'])[0]) for d in src.filter(filter_lengths)) / sample_rate
+    #
+    def tensor_bytes(t):
+        if t.dtype == tf.string:
+            return sum(len(b) for b in np.ravel(t.numpy()))
+        return t.shape.num_elements() * t.dtype.size
+    #
+    # the current resident memory of the process, in bytes
+    def rss():
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    #
+    # one pass over pds, returning the number of elements, their bytes, and the seconds taken
+    def run(pds):
+        n, nbytes = 0, 0
+        start = time.perf_counter()
+        for e in pds:
+            n      += 1
+            nbytes += sum(tensor_bytes(t) for t in tf.nest.flatten(e))
+        return n, nbytes, time.perf_counter() - start
+    #
+    print(f'{audio:.1f}s of audio in the filtered utterances')
+    print(f'{"stage":<15} {"mode":<10} {"elems/s":>9} {"audio s/s":>9} {"tensor MB":>9} {"RSS MB":>7} {"+RSS MB":>7}')
+    upstream = src
+    for k, (name, stage) in enumerate(stages):
+        cumulative = src
+        for _, s in stages[:k + 1]:
+            cumulative = s(cumulative)
+        for mode, pds in (('isolated', stage(upstream)), ('cumulative', cumulative)):
+            before          = rss()
+            n, nbytes, secs = run(pds)
+            after           = rss()
+            print(f'{name:<15} {mode:<10} {n / secs:9.1f} {audio / secs:9.1f} {nbytes / 2**20:9.1f} '
+                  f'{after / 2**20:7.0f} {(after - before) / 2**20:7.0f}')
+        # keep this stage's output in memory (filled by a first pass) as the input of the next stage
+        upstream = stage(upstream).cache()
+        run(upstream)
+
+
+if run_bench:
+    benchmark_pipeline(builder.as_dataset(split="train_clean100", shuffle_files=False, read_config=read_config))
+    print('pipeline benchmark done')
+    raise SystemExit(0)
+
+
+# The logmels are normalized with the mean and variance of each logmel dimension over every frame of
+# (unaugmented) train_clean100.  These take a full pass over the data to compute, so they're computed
+# just once and saved in the feature cache directory for this front-end configuration, from where every
+# later training run loads them instantly.  Set norm_only to compute them and stop.
+# They're then set in the model, which saves them in its checkpoints, see LASModel.set_norm_stats().
+
+norm_path = os.path.join(feature_cache_path('train_clean100'), 'norm_stats.npz')
+if not os.path.exists(norm_path):
+    print('Computing data normalization statistics...')
+    logm_ds = build_pipeline(train_ds, batch=None, corpus_split=train_corp, cache_split=train_cache)
+    compute_norm_stats(logm_ds, norm_path)
+norm_mean, norm_std = load_norm_stats(norm_path)
+if norm_only:
+    print('normalization statistics saved to', norm_path)
+    raise SystemExit(0)
+
+
+# the training pipeline, run on a local tf.data service if svc_workers > 0
+svc_target = None
+if svc_workers > 0:
+    svc_dispatcher, svc_procs = start_data_service(svc_workers)
+    svc_target = svc_dispatcher.target
+mask_ds = build_pipeline(train_ds, shuffle=True, augment=True, corpus_split=train_corp, cache_split=train_cache,
+                         service=svc_target)
 
 
 
@@ -255,20 +995,19 @@ class ListenerLayer(keras.layers.Layer):
         # bidirectional LSTM layer, whose output will be lis_dim*2 wide
         self.bi = layers.Bidirectional(layers.LSTM(lis_dim, return_sequences=True), merge_mode='concat')
         # Note that tansform() ensures that every example contains a multiple of (2 ** lis_layers) frames.
-        # The following reshapes therefore always work perfectly, without any leftovers.
+        # The following reshape and length halving therefore always work perfectly, without any leftovers.
         self.r1 = layers.Reshape((-1, lis_dim*4))
-        self.r2 = layers.Reshape((-1, 2))
         #
-    def call(self, x, mask):
-        # input shapes x = (batch, timesteps, x_dim) and mask = (batch, timesteps)
+    def call(self, x, lengths):
+        # input shapes x = (batch, timesteps, x_dim) and lengths = (batch,)
+        mask = tf.sequence_mask(lengths, maxlen=tf.shape(x)[1])
         x = self.bi(x, mask=mask)              #    x -> (batch, timesteps, lis_dim*2)
         # Take the bi outputs and reshape them so as to combine pairs of outputs by concatenation
         x = self.r1(x)                         #    x -> (batch, timesteps/2, lis_dim*4)
-        # similarly reshape the mask
-        mask = self.r2(mask)
-        mask = tf.reduce_all(mask, axis=-1)    # mask -> (batch, timesteps/2)
-        # output shapes x = (batch, timesteps/2, lis_dim*4) and mask = (batch, timesteps/2)
-        return x, mask
+        # which halves the lengths
+        lengths = lengths // 2
+        # output shapes x = (batch, timesteps/2, lis_dim*4) and lengths = (batch,)
+        return x, lengths
 
 
 # The whole multi-layer listener
@@ -283,12 +1022,13 @@ class Listener(keras.layers.Layer):
         # a final Bidirectional LSTM layer produces the listener feature sequence h
         self.bi = layers.Bidirectional(layers.LSTM(lis_dim, return_sequences=True), merge_mode='concat')
         #
-    def call(self, x, mask):
-        # input shapes x = (batch, frames, mel_dim) and mask = (batch, frames)
+    def call(self, x, lengths):
+        # input shapes x = (batch, frames, mel_dim) and lengths = (batch,)
         # apply the pyramid
         for i in range(self.lis_layers):
-            x, mask = self.lays[i](x, mask)
+            x, lengths = self.lays[i](x, lengths)
         # and produce the listener feature sequence h
+        mask = tf.sequence_mask(lengths, maxlen=tf.shape(x)[1])
         h = self.bi(x, mask=mask)
         # pd = 2 ** lis_layers, the pyramid downsampling
         # output shapes h = (batch, frames/pd, lis_dim*2) and mask = (batch, frames/pd)
@@ -311,8 +1051,8 @@ class TestModel(keras.Model):
         self.dense     = layers.Dense(num_speakers)
     def call(self, inputs):
         # models passed to fit() can only have one positional argument plus 'training'
-        logmels, logmel_mask = inputs
-        h, mask = self.listener(logmels, logmel_mask)
+        logmels, logmel_len = inputs
+        h, mask = self.listener(logmels, logmel_len)
         c = self.condenser(h, mask=mask) # -> (batch, lis_dim)
         d = self.dense(c)                # -> (batch, num_speakers) (softmax logits)
         return d
@@ -329,15 +1069,13 @@ class TestModel(keras.Model):
 # )
 # using fit requires a simpler dataset structured as (inputs, outputs)
 # def tmap(d):
-#     return (d['logmels'], d['logmel_mask']), (d['speaker_id'],)
+#     return (d['logmels'], d['logmel_len']), (d['speaker_id'],)
 # 
 # test_ds = mask_ds.map(tmap)
 # history = tmodel.fit(test_ds, epochs=1)
 # 
 # This works! :)
 
-awl = []
-
 # Attention can't be done as a layer, because attention ci is computed from si which isn't available
 # until you've run the decoder RNN to compute it from step i-1.  In other words, the attention
 # calculation has to take place at each timestep, just like the LSTM cell calculation.  These together
@@ -346,7 +1084,7 @@ awl = []
 # I think this means that I need a custom RNN Cell that does a single step of LSTM and attention.
 # The required methods and attributes of custom RNN cells are described in tf.keras.layers.RNN documentation.
 class DecoderCell(keras.layers.Layer):
-    def __init__(self, dec_dim, att_dim, lis_dim, voc_dim, frac_pyp, **kwargs):
+    def __init__(self, dec_dim, att_dim, lis_dim, voc_dim, frac_pyp, chr_dim, **kwargs):
         super(DecoderCell, self).__init__(**kwargs)
         # dec_dim will be the dimension of the DecoderCell's internal LSTMs
         self.dec_dim = dec_dim
@@ -354,8 +1092,10 @@ class DecoderCell(keras.layers.Layer):
         self.att_dim = att_dim
         # lis_dim is the LSTM dimension in the listener pyramid
         self.lis_dim = lis_dim
-        # maximum character index plus one
+        # number of character ids in the vocabulary
         self.voc_dim = voc_dim
+        # hidden dimension of the chr character distribution MLP
+        self.chr_dim = chr_dim
         # fraction of the time we should use the previous y prediction for y input
         self.frac_pyp = frac_pyp
         # call states are [memory, carry] tensors x2 for the internal LSTMs, all shaped (batch, dec_dim),
@@ -370,125 +1110,229 @@ class DecoderCell(keras.layers.Layer):
         # the LSTMs to be used in the DecoderCell
         self.lstm_cell1 = layers.LSTMCell(self.dec_dim)
         self.lstm_cell2 = layers.LSTMCell(self.dec_dim)
-        # the phi attention MLP used to compute queries
+        # the phi attention MLP used to compute queries (attention itself is done in attend_and_spell())
         self.phi1 = layers.Dense(att_dim * 2, activation='relu')
         self.phi2 = layers.Dense(att_dim)
         # the chr character distribution MLP
-        self.chr1 = layers.Dense(voc_dim * 4, activation='relu')
+        self.chr1 = layers.Dense(chr_dim, activation='relu')
         self.chr2 = layers.Dense(voc_dim)
-        # the attention layer
-        self.att  = layers.Attention()
         #
     def call(self, input_at_t, states_at_t, training, constants=None):
+        # return outputs at time t, states at time t+1
+        # see https://www.tensorflow.org/api_docs/python/tf/keras/layers/RNN
+        yp, states, _ = self.step(input_at_t, states_at_t, training, constants)
+        return yp, states
+        #
+    def step(self, input_at_t, states_at_t, training, constants):
+        # One decoder step, returning its y prediction, its new states, and its attention weights.
         #
         # input_at_t should be the 1-hot ground truth character vector at timestep i-1
         yin = input_at_t      # shape (batch, voc_dim)
         # states_at_t should be [memory, carry]x2 [psv, pcv, pyp] tensors, see state_size above
         pmc1 = states_at_t[0:2] # previous memory and carry for internal LSTM 1
-        pmc2 = states_at_t[2:4] # previous memory and carry for internal LSTM 2
         psv  = states_at_t[4]   # previous s vector, shape (batch, dec_dim)
         pcv  = states_at_t[5]   # previous context vector, shape (batch, lis_dim*2)
         pyp  = states_at_t[6]   # previous y prediction, shape (batch, voc_dim) (as logits)
-        # training is a Python boolean usually used to control dropout but used here to control logging
+        # training is a Python boolean usually used to control dropout (there's none in this cell)
         # constants is a keyword argument that can be passed to RNN.__call__() which contains constants:
-        listener_features = constants[0] # shape (batch, frames/pd, lis_dim*2)
-        listener_keys     = constants[1] # shape (batch, frames/pd, att_dim)
-        listener_mask     = constants[2] # shape (batch, frames/pd)
-        blend             = constants[3] # shape () tf.bool
+        # [listener_features, listener_keys_t, listener_bias, blend], see attend_and_spell() for the first 3
+        blend = constants[3]    # shape () tf.bool
         #
         # When blending inputs the y to use (ytu) is produced as either yin (teacher-forcing) or a
         # sample drawn from the previous y prediction (pyp) distribution (to improve model robustness).
         # The decision of which to use is determined randomly, such that frac_pyp are from pyp.
-        pypdist = tfp.distributions.OneHotCategorical(logits=pyp)
-        sample  = pypdist.sample()                                    # shape (batch, voc_dim) int32
-        sample  = tf.cast(sample, tf.float32)                         # shape (batch, voc_dim) float32
-        rut     = tf.random.uniform((tf.shape(yin)[0],), seed=1)      # shape (batch,)   floats in [0,1)
-        rut     = rut[:, None]                                        # shape (batch, 1) floats in [0,1)
-        ytu     = tf.cast(rut <  self.frac_pyp, tf.float32) * sample  # shape (batch, voc_dim) float32
-        ytu    += tf.cast(rut >= self.frac_pyp, tf.float32) * yin     # shape (batch, voc_dim) float32
-        ytu    *= tf.cast(blend, tf.float32)                          # shape (batch, voc_dim) float32
-        # When not blending inputs the y to use (ytu) is always yin.
-        ytu    += tf.cast(tf.logical_not(blend), tf.float32) * yin    # shape (batch, voc_dim) float32
+        # When not blending inputs, or when frac_pyp is 0, the y to use (ytu) is always yin, and no
+        # sample is drawn at all.
+        if self.frac_pyp > 0:
+            ytu = tf.cond(blend, lambda: self.blend_input(yin, pyp), lambda: yin)
+        else:
+            ytu = yin                                                 # shape (batch, voc_dim) float32
         #
         # concatenate psv, ytu and pcv, to produce (batch, dec_dim + voc_dim + lis_dim*2)
-        rnni = layers.concatenate([psv, ytu, pcv])
+        rnni = tf.concat([psv, ytu, pcv], axis=-1)
         #
-        # Run the internal LSTM cells on the concatenated input to compute s(i), shape (batch, dec_dim).
+        # Run the first internal LSTM cell on the concatenated input
         o1, nmc1 = self.lstm_cell1(rnni, pmc1)
+        return self.attend_and_spell(o1, nmc1, states_at_t, training, constants)
+        #
+    def hoisted_call(self, yproj, states_at_t, training, constants):
+        # The same step as call() when ytu is always yin (teacher-forcing), for DecoderStep.
+        # yproj is the ytu part of the first LSTM's input projection, plus its bias, (batch, dec_dim*4),
+        # computed for every timestep before the loop, so only the psv, pcv and recurrent parts are done here.
+        h1, c1 = states_at_t[0:2]
+        psv    = states_at_t[4]
+        pcv    = states_at_t[5]
+        w_sc   = constants[4]    # the psv and pcv rows of lstm_cell1's kernel, (dec_dim + lis_dim*2, dec_dim*4)
+        z  = yproj + tf.matmul(tf.concat([psv, pcv], axis=-1), w_sc)
+        z += tf.matmul(h1, self.lstm_cell1.recurrent_kernel)
+        # the LSTMCell gates, in its order i, f, c, o
+        zi, zf, zc, zo = tf.split(z, 4, axis=-1)
+        c1 = tf.sigmoid(zf) * c1 + tf.sigmoid(zi) * tf.tanh(zc)
+        o1 = tf.sigmoid(zo) * tf.tanh(c1)
+        return self.attend_and_spell(o1, [o1, c1], states_at_t, training, constants)
+        #
+    def attend_and_spell(self, o1, nmc1, states_at_t, training, constants):
+        # The rest of the step, from the output o1 and new memory and carry nmc1 of the first LSTM cell
+        pmc2 = states_at_t[2:4] # previous memory and carry for internal LSTM 2
+        listener_features = constants[0] # shape (batch, frames/pd, lis_dim*2)
+        listener_keys_t   = constants[1] # shape (batch, att_dim, frames/pd), the transposed keys
+        listener_bias     = constants[2] # shape (batch, frames/pd), 0 for frames, -1e9 for padding
+        #
+        # Run the second internal LSTM cell to compute s(i), shape (batch, dec_dim).
         si, nmc2 = self.lstm_cell2(o1, pmc2)
         #
         # Apply the phi attention MLP to si, producing (batch, att_dim)
         m1 = self.phi1(si)
         m2 = self.phi2(m1)
         # Reshape m2 into the query, shape (batch, 1, att_dim)
-        query = layers.Reshape((1, self.att_dim))(m2)
-        #
-        # Compute attention context vector ci with argument [query, value, key]
-        # This should yield shape (batch, 1, lis_dim*2)
-        c1 = self.att([query, listener_features, listener_keys], mask=[None, listener_mask])
-        #
-        # The attention weights can be plotted to see how well the model attends to the acoustics.
-        # TF2.3.0 layers.Attention() does not have an option to return attention weights.
-        # However, it can be tricked into returning them by sending an identity matrix as value.
-        # It would be a waste of time to do this additional computation at every training step.
-        # The following code therefore only runs when the training boolean is False.
-        if training == False:
-            # prepare identity tensor (1, frames, frames); the 1 will broadcast over batch
-            frames = tf.shape(listener_features)[1]
-            it     = tf.keras.initializers.Identity()(shape=(frames, frames))[None,:,:]
-            # extract the attention weights (batch, 1, frames)
-            aw = self.att([query, it, listener_keys], mask=[None, listener_mask])
-            # squeeze out the 1 (and the batch if it is 1 which usually it is when running this)
-            aw = tf.squeeze(aw)
-            # append to awl
-            # this wont do anything useful under tf.function(); it must be called without tf.function()
-            awl.append(aw)
-        #
-        # Reshape c1 to produce (batch, lis_dim*2)
-        ci = layers.Reshape((-1,))(c1)
+        query = m2[:, None, :]
+        #
+        # Dot-product attention, computing what layers.Attention() computes (unscaled scores, with
+        # padding frames pushed to -1e9 before the softmax), but with the keys already transposed and
+        # the mask already turned into a bias by LASModel.listen(), once per utterance.
+        # The scores and the context vector are each one batched matvec.
+        scores = tf.matmul(query, listener_keys_t)[:, 0, :] + listener_bias   # shape (batch, frames/pd)
+        aw     = tf.nn.softmax(scores)                                         # shape (batch, frames/pd)
+        ci     = tf.matmul(aw[:, None, :], listener_features)[:, 0, :]         # shape (batch, lis_dim*2)
         #
         # concatenate si and ci to produce (batch, dec_dim + lis_dim*2)
-        sc = layers.concatenate([si,ci])
+        sc = tf.concat([si, ci], axis=-1)
         #
         # The character distribution MLP predicts y as softmax logits over characters (batch, voc_dim)
         ch = self.chr1(sc)
         yp = self.chr2(ch)
         #
-        # return outputs at time t, states at time t+1
-        # see https://www.tensorflow.org/api_docs/python/tf/keras/layers/RNN
-        return yp, nmc1 + nmc2 + [si] + [ci] + [yp]
+        # return the y prediction, the states at time t+1, and the attention weights (batch, frames/pd),
+        # which can be plotted to see how well the model attends to the acoustics
+        return yp, nmc1 + nmc2 + [si] + [ci] + [yp], aw
+    #
+    def blend_input(self, yin, pyp):
+        # yin 1-hot (batch, voc_dim), or pyp 1-hot sampled from its logits (batch, voc_dim), such that
+        # each example's sample is used with probability frac_pyp
+        sample = tf.random.categorical(pyp, 1)[:, 0]                   # shape (batch,) int64
+        sample = tf.one_hot(sample, self.voc_dim)                      # shape (batch, voc_dim) float32
+        rut    = tf.random.uniform((tf.shape(yin)[0], 1), seed=1)      # shape (batch, 1) floats in [0,1)
+        return tf.where(rut < self.frac_pyp, sample, yin)              # shape (batch, voc_dim) float32
     # The cell could also define a get_initial_state() method, but it doesn't.
     # That means the rnn will feed zeros to call() for the initial state instead.
 
 
+# A DecoderStep runs a DecoderCell's step in a layers.RNN, sharing the DecoderCell's weights, in two
+# optional ways:
+# hoisted   : When the decoder is teacher-forced (not blending, or with frac_pyp 0) its y input is known
+#             for every timestep before the loop starts, so the y part of the first LSTM's input projection
+#             can be computed for all timesteps at once, rather than one small matmul per step inside the
+#             recurrence.  Since the y inputs are 1-hot this is a gather of the kernel's y rows.
+#             The step's inputs are then those precomputed projections, see LASModel.call_hoisted().
+# attention : The attention weights (batch, frames/pd) are a second output of each step, so the RNN
+#             returns them for every character, at no extra cost, and under tf.function too.
+class DecoderStep(keras.layers.Layer):
+    def __init__(self, cell, hoisted=False, attention=False, **kwargs):
+        super(DecoderStep, self).__init__(**kwargs)
+        self.cell       = cell
+        self.hoisted    = hoisted
+        self.attention  = attention
+        self.state_size = cell.state_size
+        if attention:
+            self.output_size = [cell.output_size, tf.TensorShape([None])]
+        else:
+            self.output_size = cell.output_size
+        #
+    def call(self, input_at_t, states_at_t, training, constants=None):
+        # input_at_t is the precomputed projection (batch, dec_dim*4) if hoisted, else 1-hot (batch, voc_dim)
+        if self.hoisted:
+            yp, states, aw = self.cell.hoisted_call(input_at_t, states_at_t, training, constants)
+        else:
+            yp, states, aw = self.cell.step(input_at_t, states_at_t, training, constants)
+        if self.attention:
+            return [yp, aw], states
+        return yp, states
+
+
 # The Listen Attend Spell Model
 class LASModel(keras.Model):
-    def __init__(self, lis_dim, lis_layers, dec_dim, att_dim, voc_dim, frac_pyp, max_dec, **kwargs):
+    def __init__(self, lis_dim, lis_layers, dec_dim, att_dim, vocab, frac_pyp, max_dec, chr_dim, mel_dim,
+                 hoist_inputs, **kwargs):
         super(LASModel, self).__init__(**kwargs)
         # maximum number of characters to decode in the decode() function
         self.max_dec  = max_dec
         # DecoderCell parameters required in the decode() function
         self.lis_dim  = lis_dim
         self.dec_dim  = dec_dim
-        self.voc_dim  = voc_dim
+        self.voc_dim  = vocab.size
+        # the vocabulary, for its <sos> and <eos> ids
+        self.vocab    = vocab
         # record for debugging
         self.lis_layers = lis_layers
         self.frac_pyp   = frac_pyp
         self.att_dim    = att_dim        
+        self.chr_dim    = chr_dim
+        # the logmel dimension, for the normalization statistics
+        self.mel_dim    = mel_dim
+        # when teacher-forcing, compute the decoder's y input projections before its loop, see call_hoisted()
+        self.hoist_inputs = hoist_inputs
         # the listener pyramid
         self.listener = Listener(lis_dim, lis_layers)
         # the psi attention MLP used to compute the listener keys
         self.psi1     = layers.Dense(att_dim * 2, activation='relu')
         self.psi2     = layers.Dense(att_dim)
         # the decoder cell and rnn
-        self.cell     = DecoderCell(dec_dim, att_dim, lis_dim, voc_dim, frac_pyp)
+        self.cell     = DecoderCell(dec_dim, att_dim, lis_dim, vocab.size, frac_pyp, chr_dim)
         self.rnn      = layers.RNN(self.cell, return_sequences=True)
+        # the same decoder cell, run on precomputed y input projections when teacher-forcing,
+        # and (either way) also returning the attention weights, see DecoderStep
+        self.rnn_hoisted     = layers.RNN(DecoderStep(self.cell, hoisted=True), return_sequences=True)
+        self.rnn_att         = layers.RNN(DecoderStep(self.cell, attention=True), return_sequences=True)
+        self.rnn_hoisted_att = layers.RNN(DecoderStep(self.cell, hoisted=True, attention=True),
+                                          return_sequences=True)
+        # The logmel normalization statistics are non-trainable model state, so every checkpoint holds
+        # them, and callers pass the model raw logmels.  norm_folded is True once fold_normalization()
+        # has folded them into the first listener layer.
+        self.norm_mean   = tf.Variable(tf.zeros(mel_dim), trainable=False, name='norm_mean')
+        self.norm_std    = tf.Variable(tf.ones(mel_dim),  trainable=False, name='norm_std')
+        self.norm_folded = tf.Variable(False,             trainable=False, name='norm_folded')
+        #
+    def build_weights(self):
+        # build the model's weights with a tiny dummy batch, unless a call has already built them
+        if self.built:
+            return
+        pd = 2 ** self.lis_layers
+        self([tf.zeros((1, 2), tf.int32), tf.ones((1, 2), tf.bool),
+              tf.zeros((1, pd, self.mel_dim)), tf.constant([pd]), tf.constant(False)], training=False)
+    #
+    def set_norm_stats(self, mean, std):
+        # set the per-logmel mean and standard deviation used to normalize the logmels
+        # Once they've been folded into the listener weights, new ones would be applied on top of the old.
+        assert not self.norm_folded.numpy(), "the normalization is folded into the listener, it can't be reset"
+        self.norm_mean.assign(mean)
+        self.norm_std.assign(std)
+    #
+    def fold_normalization(self):
+        # Fold the normalization into the input kernels and biases of the first listener layer's LSTMs,
+        # since ((x - mean) / std) W + b = x (W / std) + (b - (mean / std) W), so that serving skips the
+        # normalize op.  Padding frames are transformed exactly as before, so nothing else changes.
+        if self.norm_folded.numpy():
+            return
+        # The weights may not exist yet, e.g. after restoring a checkpoint into a model that's never been called.
+        self.build_weights()
+        scale = 1.0 / self.norm_std                           # (mel_dim,)
+        shift = -self.norm_mean * scale                       # (mel_dim,)
+        bi    = self.listener.lays[0].bi
+        for cell in [bi.forward_layer.cell, bi.backward_layer.cell]:
+            # kernel shape (mel_dim, lis_dim*4), bias shape (lis_dim*4,)
+            cell.bias.assign_add(tf.linalg.matvec(cell.kernel, shift, transpose_a=True))
+            cell.kernel.assign(cell.kernel * scale[:, None])
+        self.norm_folded.assign(True)
+    #
+    def listen(self, logmels, logmel_len):
+        # The listen() function computes the listener representation, and the transposed keys and
+        # additive mask bias which the DecoderCell's attention uses at every step.
         #
-    def listen(self, logmels, logmel_mask):
-        # The listen() function computes the listener representation, keys and mask.
+        # normalize the logmels to have 0 mean and stdev 1 in each dimension (unless that's been folded)
+        logmels = tf.cond(self.norm_folded, lambda: logmels, lambda: (logmels - self.norm_mean) / self.norm_std)
         #
         # compute the listener representation h and its mask
-        h, hmask = self.listener(logmels, logmel_mask)        
+        h, hmask = self.listener(logmels, logmel_len)
         # h           shape (batch, frames/pd, lis_dim*2)
         # hmask       shape (batch, frames/pd)
         #
@@ -496,98 +1340,170 @@ class LASModel(keras.Model):
         l1   = self.psi1(h)
         hkey = self.psi2(l1)
         # hkey        shape (batch, frames/pd, att_dim)
-        return h, hkey, hmask
+        #
+        # The keys and mask are the same for every decoder step, so they're prepared for it here, once:
+        # the keys transposed for the scores matmul, and the mask as a bias added to the scores.
+        hkeyt = tf.transpose(hkey, [0, 2, 1])
+        hbias = (1.0 - tf.cast(hmask, tf.float32)) * -1e9
+        # hkeyt       shape (batch, att_dim, frames/pd)
+        # hbias       shape (batch, frames/pd)
+        return h, hkeyt, hbias
     #
-    def call(self, inputs, training):
+    def call(self, inputs, training, return_attention=False):
         # keras models like all their inputs in the first argument
-        yins, ymask, logmels, logmel_mask, blend = inputs
+        yins, ymask, logmels, logmel_len, blend = inputs
         # The call() function operates an rnn, to be used for training/validation/teacher-forced-prediction.
+        # With return_attention it returns the attention weights too, see the end of this function.
         #
-        # yins        shape (batch, nchars, voc_dim)
+        # yins        shape (batch, nchars) int32 character ids
         # ymask       shape (batch, nchars)
         # logmels     shape (batch, frames, mel_dim)
-        # logmel_mask shape (batch, frames)
+        # logmel_len  shape (batch,) the number of frames in each example
         # blend       shape () tf boolean
         # training    Python boolean
         #
-        # compute the listener representation, key and mask
-        h, hkey, hmask = self.listen(logmels, logmel_mask)
+        # compute the listener representation, transposed keys and mask bias
+        h, hkeyt, hbias = self.listen(logmels, logmel_len)
         # h           shape (batch, frames/pd, lis_dim*2)
-        # hkey        shape (batch, frames/pd, att_dim)
-        # hmask       shape (batch, frames/pd)
+        # hkeyt       shape (batch, att_dim, frames/pd)
+        # hbias       shape (batch, frames/pd)
+        #
+        # When teacher-forcing (not blending, or frac_pyp 0) the y part of the first decoder LSTM's input
+        # projection is computed for every timestep here, before the decoder loop.
+        if self.hoist_inputs and (self.frac_pyp == 0 or tf.get_static_value(blend) == False):
+            return self.call_hoisted(yins, ymask, h, hkeyt, hbias, blend, training, return_attention)
+        #
+        # The DecoderCell takes 1-hot inputs, which are only made here, on the device.
+        yins = tf.one_hot(yins, self.voc_dim)
+        # yins        shape (batch, nchars, voc_dim)
         #
         # Compute the y predictions as softmax logits.
         # Since y is post-padded and masked outputs are not used the ymask is optional here.
-        yps = self.rnn(yins, mask=ymask, training=training, constants=[h, hkey, hmask, blend])
+        rnn = self.rnn_att if return_attention else self.rnn
+        yps = rnn(yins, mask=ymask, training=training, constants=[h, hkeyt, hbias, blend])
         # yps          shape (batch, nchars, voc_dim)
+        # or with return_attention [yps, aws], where
+        # aws          shape (batch, nchars, frames/pd), the attention weights of every character
         #
         return yps
     #
-    def decode(self, logmels, logmel_mask):
-        # The decode() function performs decoding, predicting unknown characters from logmels.
+    def call_hoisted(self, yins, ymask, h, hkeyt, hbias, blend, training, return_attention=False):
+        # call() with the teacher-forced y input projections hoisted out of the decoder loop
+        cell1 = self.cell.lstm_cell1
+        if not cell1.built:
+            cell1.build(tf.TensorShape([None, self.dec_dim + self.voc_dim + self.lis_dim*2]))
+        # lstm_cell1's kernel rows are for its input [psv, ytu, pcv]
+        w_y   = cell1.kernel[self.dec_dim:self.dec_dim + self.voc_dim]           # (voc_dim, dec_dim*4)
+        w_sc  = tf.concat([cell1.kernel[:self.dec_dim],
+                           cell1.kernel[self.dec_dim + self.voc_dim:]], axis=0)  # (dec_dim + lis_dim*2, dec_dim*4)
+        # the 1-hot yins times w_y, plus the bias, for all timesteps at once
+        yproj = tf.gather(w_y, yins) + cell1.bias                                # (batch, nchars, dec_dim*4)
+        rnn   = self.rnn_hoisted_att if return_attention else self.rnn_hoisted
+        yps   = rnn(yproj, mask=ymask, training=training, constants=[h, hkeyt, hbias, blend, w_sc])
+        # yps          shape (batch, nchars, voc_dim), or [yps, aws] as in call()
+        return yps
+    #
+    def decode(self, logmels, logmel_len):
+        # The decode() function performs greedy decoding of a batch, predicting unknown characters from logmels.
         # 
         # logmels     shape (batch, frames, mel_dim)
-        # logmel_mask shape (batch, frames)
+        # logmel_len  shape (batch,)
         #
-        # where this function expects batch = 1
-        tf.debugging.assert_equal(tf.shape(logmels)[0],     1, message="las.decode() expects batch_size 1")
-        tf.debugging.assert_equal(tf.shape(logmel_mask)[0], 1, message="las.decode() expects batch_size 1")
+        # Each row decodes until it produces the <eos> token (or max_dec characters).  A finished row is
+        # frozen, keeping its state and producing more <eos> tokens as padding, and the loop stops as soon
+        # as every row has finished.  Decoding works best on batches of similar lengths, see decode_sorted().
         #
-        # compute the listener representation, key and mask
-        h, hkey, hmask = self.listen(logmels, logmel_mask)
+        # returns ids shape (batch, nchars) int32, padded with <eos>, and lengths shape (batch,) int32,
+        # the number of characters decoded by each row, including its <eos>
+        #
+        # compute the listener representation, transposed keys and mask bias
+        h, hkeyt, hbias = self.listen(logmels, logmel_len)
         # h           shape (batch, frames/pd, lis_dim*2)
-        # hkey        shape (batch, frames/pd, att_dim)
-        # hmask       shape (batch, frames/pd)
+        # hkeyt       shape (batch, att_dim, frames/pd)
+        # hbias       shape (batch, frames/pd)
         #
+        batch    = tf.shape(logmels)[0]
         # the DecoderCell should not blend its inputs when decoding
         blend    = tf.constant(False)
         # the <sos> token is always the first input
-        sos_text = b'^'
-        sos_code = tf.strings.unicode_decode(sos_text,'utf-8')
-        yin      = tf.one_hot(sos_code, self.voc_dim)            # (1, voc_dim)
-        # the <eos> token tells us when to stop decoding
-        eos_text = b'$'
-        eos_code = tf.strings.unicode_decode(eos_text,'utf-8')
-        # use TensorArray to accumulate a sparse array of unknown size of decoded int32s
-        dec_ta   = tf.TensorArray(tf.int32, size=0, dynamic_size=True, clear_after_read=True)
+        yd       = tf.fill([batch], self.vocab.sos_id)           # (batch,) sparse int32
+        # the <eos> token tells us when each row has finished
+        eos_code = tf.constant(self.vocab.eos_id)
+        finished = tf.zeros([batch], dtype=tf.bool)
+        lengths  = tf.zeros([batch], dtype=tf.int32)
+        # use TensorArray to accumulate (batch,) decoded int32s for an unknown number of steps
+        dec_ta   = tf.TensorArray(tf.int32, size=0, dynamic_size=True)
         dec_i    = 0
-        # initial state for the DecoderCell with batch_size of 1
-        istate   = [tf.zeros((1, self.dec_dim)), tf.zeros((1, self.dec_dim)),
-                    tf.zeros((1, self.dec_dim)), tf.zeros((1, self.dec_dim)),
-                    tf.zeros((1, self.dec_dim)), tf.zeros((1, self.lis_dim*2)),
-                    tf.zeros((1, self.voc_dim))]
-        state    = istate
-        # initial y decoded (for loop comparisons)
-        yd       = sos_code
+        # initial state for the DecoderCell
+        state    = [tf.zeros((batch, self.dec_dim)), tf.zeros((batch, self.dec_dim)),
+                    tf.zeros((batch, self.dec_dim)), tf.zeros((batch, self.dec_dim)),
+                    tf.zeros((batch, self.dec_dim)), tf.zeros((batch, self.lis_dim*2)),
+                    tf.zeros((batch, self.voc_dim))]
         # prepare while loop functions
-        def cond(yin, state, yd, dec_ta, dec_i):
-            return yd != eos_code
+        def cond(yd, state, finished, lengths, dec_ta, dec_i):
+            return tf.logical_not(tf.reduce_all(finished))
         #
-        def body(yin, state, yd, dec_ta, dec_i):
-            yp, state = self.cell(yin, state, training=False, constants=[h, hkey, hmask, blend])
-            # yp shape (1, voc_dim)
+        def body(yd, state, finished, lengths, dec_ta, dec_i):
+            yin = tf.one_hot(yd, self.voc_dim)                   # (batch, voc_dim)
+            yp, nstate = self.cell(yin, state, training=False, constants=[h, hkeyt, hbias, blend])
+            # yp shape (batch, voc_dim)
             #
             # in this simple decoder the most likely character becomes the decoded char for this timestep
-            yd     = tf.argmax(yp, axis=-1)                      # (1,) sparse decoded int64
-            yd     = tf.cast(yd, tf.int32)                       # (1,) sparse decoded int32
+            yn       = tf.cast(tf.argmax(yp, axis=-1), tf.int32)   # (batch,) sparse decoded int32
+            # finished rows keep their state and produce <eos> padding
+            yn       = tf.where(finished, eos_code, yn)
+            state    = [tf.where(finished[:, None], s, ns) for s, ns in zip(state, nstate)]
+            lengths += tf.cast(tf.logical_not(finished), tf.int32)
+            finished = tf.logical_or(finished, tf.equal(yn, eos_code))
             # accumulate
-            dec_ta = dec_ta.write(dec_i, yd)
-            dec_i += 1
-            # prepare next input
-            yin    = tf.one_hot(yd, self.voc_dim)                # (1, voc_dim)
+            dec_ta   = dec_ta.write(dec_i, yn)
+            dec_i   += 1
             # return loop vars
-            return yin, state, yd, dec_ta, dec_i
+            return yn, state, finished, lengths, dec_ta, dec_i
         #
-        yin, state, yd, dec_ta, dec_i = tf.while_loop(
-            cond, body, (yin, state, yd, dec_ta, dec_i), maximum_iterations=self.max_dec)
+        yd, state, finished, lengths, dec_ta, dec_i = tf.while_loop(
+            cond, body, (yd, state, finished, lengths, dec_ta, dec_i), maximum_iterations=self.max_dec)
         #
-        dec_st = tf.squeeze(dec_ta.stack())                      # (nchars,) sparse decoded int32
-        return dec_st
+        ids = tf.transpose(dec_ta.stack())                       # (batch, nchars) sparse decoded int32
+        return ids, lengths
 
 
 
 # instantiate the model
-las = LASModel(lis_dim, lis_layers, dec_dim, att_dim, voc_dim, frac_pyp, max_dec)
+las = LASModel(lis_dim, lis_layers, dec_dim, att_dim, vocab, frac_pyp, max_dec, chr_dim, mel_dim, hoist_inputs)
+las.set_norm_stats(norm_mean, norm_std)
+
+
+# Models used to be trained with unicode code points as character ids, so voc_dim was 123.
+# convert_checkpoint() converts the model in such a checkpoint into one for the dense vocabulary.
+# Only the weights that touch the vocabulary change: the 1-hot y input rows of the first decoder LSTM
+# kernel, and the columns of the final character distribution layer, which are selected by code point.
+# The optimizer state is not converted, so restore the converted checkpoint with expect_partial().
+# It's written with write() rather than save(), so it doesn't become the latest checkpoint of its directory.
+def convert_checkpoint(old_path, new_path):
+    old_vocab = Vocabulary(''.join(chr(i) for i in range(123)))  # ids are code points
+    old_las   = LASModel(lis_dim, lis_layers, dec_dim, att_dim, old_vocab, frac_pyp, max_dec, chr_dim, mel_dim,
+                         hoist_inputs)
+    new_las   = LASModel(lis_dim, lis_layers, dec_dim, att_dim, vocab,     frac_pyp, max_dec, chr_dim, mel_dim,
+                         hoist_inputs)
+    old_las.build_weights()
+    new_las.build_weights()
+    tf.train.Checkpoint(model=old_las).restore(old_path).expect_partial()
+    # the old ids (code points) of each new id
+    keep = np.array([ord(c) for c in vocab.chars])
+    for ov, nv in zip(old_las.weights, new_las.weights):
+        w = ov.numpy()
+        if ov is old_las.cell.lstm_cell1.kernel:
+            # the lstm_cell1 input is [psv, ytu, pcv]
+            w = np.concatenate([w[:dec_dim], w[dec_dim + keep], w[dec_dim + old_vocab.size:]])
+        elif ov is old_las.cell.chr2.kernel:
+            w = w[:, keep]
+        elif ov is old_las.cell.chr2.bias:
+            w = w[keep]
+        nv.assign(w)
+    # the old checkpoint has no normalization statistics
+    new_las.set_norm_stats(norm_mean, norm_std)
+    return tf.train.Checkpoint(model=new_las).write(new_path)
 
 
 # optimizer
@@ -616,7 +1532,7 @@ val_acc    = tf.keras.metrics.Mean()
 
 
 # loss function
-loss_object = tf.keras.losses.CategoricalCrossentropy(from_logits=True, reduction='none')
+loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
 
 @tf.autograph.experimental.do_not_convert
 def loss_function(tars, mask, logits):
@@ -631,8 +1547,8 @@ def loss_function(tars, mask, logits):
 @tf.autograph.experimental.do_not_convert
 def acc_function(tars, mask, logits):
     # accuracies of pads must not be counted
-    preds = tf.argmax(logits, axis=-1)       # (batch, nchars)
-    tars  = tf.argmax(tars, axis=-1)         # (batch, nchars)
+    preds = tf.argmax(logits, axis=-1)       # (batch, nchars) int64
+    tars  = tf.cast(tars, preds.dtype)       # (batch, nchars) int64
     acc   = tf.equal(tars, preds)            # (batch, nchars) bools
     acc   = tf.cast(acc, tf.float32)         # (batch, nchars) float32s
     mask  = tf.cast(mask, tf.float32)        # (batch, nchars) float32s, 0 for pads
@@ -648,8 +1564,10 @@ def acc_function(tars, mask, logits):
 # more generic shapes.
 
 signature_dict = { 'logmels'     : tf.TensorSpec(shape=(None, None, mel_dim), dtype=tf.float32),
+                   'logmel_len'  : tf.TensorSpec(shape=(None),                dtype=tf.int32),
                    'logmel_mask' : tf.TensorSpec(shape=(None, None),          dtype=tf.bool),
-                   'ygt'         : tf.TensorSpec(shape=(None, None, voc_dim), dtype=tf.float32),
+                   'ygt'         : tf.TensorSpec(shape=(None, None),          dtype=tf.int32),
+                   'ygt_len'     : tf.TensorSpec(shape=(None),                dtype=tf.int32),
                    'ygt_mask'    : tf.TensorSpec(shape=(None, None),          dtype=tf.bool),
                    'speaker_id'  : tf.TensorSpec(shape=(None),                dtype=tf.int64) }
 
@@ -658,20 +1576,20 @@ signature_dict = { 'logmels'     : tf.TensorSpec(shape=(None, None, mel_dim), dt
 @tf.autograph.experimental.do_not_convert
 def train_step(d):
     # ygt is ground truth chars, including start and end characters
-    ygt        = d['ygt']         # (batch, nchars, voc_dim)
+    ygt        = d['ygt']         # (batch, nchars)
     ygt_mask   = d['ygt_mask']    # (batch, nchars)
     # y inputs exclude end character
-    yins       = ygt[:, :-1]      # (batch, nchars, voc_dim)
+    yins       = ygt[:, :-1]      # (batch, nchars)
     yins_mask  = ygt_mask[:, :-1] # (batch, nchars)
     # y targets exclude the start character
-    ytars      = ygt[:, 1:]       # (batch, nchars, voc_dim)
+    ytars      = ygt[:, 1:]       # (batch, nchars)
     ytars_mask = ygt_mask[:, 1:]  # (batch, nchars) 
     # training blends ground truth inputs with predictions
     blend = tf.constant(True)
     # the training boolean is set to True to avoid wasting time recomputing attention weights
     with tf.GradientTape() as tape:
         # call the model to obtain the y predictions (logits) (batch, nchars, voc_dim)
-        yps = las([yins, yins_mask, d['logmels'], d['logmel_mask'], blend], training=True)
+        yps = las([yins, yins_mask, d['logmels'], d['logmel_len'], blend], training=True)
         # compute the loss
         loss = loss_function(ytars, ytars_mask, yps)
     #
@@ -691,20 +1609,20 @@ def train_step(d):
 @tf.autograph.experimental.do_not_convert
 def val_step(d):
     # ygt is ground truth chars, including start and end characters
-    ygt        = d['ygt']         # (batch, nchars, voc_dim)
+    ygt        = d['ygt']         # (batch, nchars)
     ygt_mask   = d['ygt_mask']    # (batch, nchars)
     # y inputs exclude end character
-    yins       = ygt[:, :-1]      # (batch, nchars, voc_dim)
+    yins       = ygt[:, :-1]      # (batch, nchars)
     yins_mask  = ygt_mask[:, :-1] # (batch, nchars)
     # y targets exclude the start character
-    ytars      = ygt[:, 1:]       # (batch, nchars, voc_dim)
+    ytars      = ygt[:, 1:]       # (batch, nchars)
     ytars_mask = ygt_mask[:, 1:]  # (batch, nchars)
     # blend is True so that validation loss/acc are comparable to training loss/acc
     # similarly training is True so that I don't waste time recomputing attention weights
     # (validation results are only useful comparatively since this is not the ultimate task)
     blend = tf.constant(True)
     # call the model to obtain the y predictions (logits) (batch, nchars, voc_dim)
-    yps = las([yins, yins_mask, d['logmels'], d['logmel_mask'], blend], training=True)
+    yps = las([yins, yins_mask, d['logmels'], d['logmel_len'], blend], training=True)
     # accumulate
     val_loss(loss_function(ytars, ytars_mask, yps))
     val_acc(acc_function(ytars, ytars_mask, yps))
@@ -712,14 +1630,7 @@ def val_step(d):
 
 # I'll use the dev set as validation data
 dev_ds    = builder.as_dataset(split="dev_clean")
-dfi_ds    = dev_ds.filter(filter_lengths)
-dau_ds    = dfi_ds.map(wav_augment)
-dtr_ds    = dau_ds.map(transform)
-dno_ds    = dtr_ds.map(normalize)
-dpd_ds    = dno_ds.padded_batch(
-    batch_size,
-    padded_shapes=({'logmels' : (None, mel_dim), 'speaker_id' : (), 'ygt' : (None, voc_dim)}))
-dmk_ds    = dpd_ds.map(gen_masks)
+dmk_ds    = build_pipeline(dev_ds, augment=True, corpus_split=dev_corp)
 # I'll validate on about 512 utterances
 val_steps = 512 // batch_size
 
@@ -730,6 +1641,13 @@ checkpoint           = tf.train.Checkpoint(optimizer=optimizer, model=las)
 checkpoint_directory = './checkpoints'
 checkpoint_prefix    = os.path.join(checkpoint_directory, 'ckpt')
 
+# A converted checkpoint is written in its own subdirectory, and then training starts from its model weights
+# (with a fresh optimizer, unless there's a resumable checkpoint to resume from, see below).
+if convert_from is not None:
+    converted = convert_checkpoint(convert_from, os.path.join(checkpoint_directory, 'converted', 'ckpt'))
+    print('converted checkpoint saved to', converted)
+    tf.train.Checkpoint(model=las).restore(converted).expect_partial()
+
 
 # setup tensorboard logging directories
 # run "tensorboard --logdir logs" in shell
@@ -741,13 +1659,44 @@ train_summary_writer = tf.summary.create_file_writer(train_log_dir)
 val_summary_writer   = tf.summary.create_file_writer(val_log_dir)
 
 
+# Resumable checkpoints are saved every resume_every batches.  As well as the model and optimizer they
+# hold the training pipeline's iterator (its shuffle buffers, position, and augmentation seed stream) and
+# the epoch and batch counters, so that a restarted run resumes at the batch after the last one trained,
+# and sees exactly the batches that it would have seen if it hadn't stopped.  (With ordered False, or
+# on the tf.data service, whose iterators cannot be saved, the batches may differ.)  They also hold the
+# epoch checkpoint's save counter, so that after a restart the epoch checkpoints go on being numbered
+# after the ones already saved, rather than overwriting them from ckpt-1 again.
+# The iterator is replaced at the start of each epoch, and only the latest two checkpoints are kept.
+epoch_var  = tf.Variable(0, dtype=tf.int64)   # number of epochs completed
+batch_var  = tf.Variable(0, dtype=tf.int64)   # number of batches of the current epoch completed
+gstep_var  = tf.Variable(0, dtype=tf.int64)   # global step counter
+train_iter = iter(mask_ds)
+resumable  = tf.train.Checkpoint(optimizer=optimizer, model=las, epoch=epoch_var, batch=batch_var, gstep=gstep_var,
+                                 epoch_saves=checkpoint.save_counter)
+if svc_target is None:
+    resumable.iterator = train_iter
+resume_manager = tf.train.CheckpointManager(resumable, os.path.join(checkpoint_directory, 'resume'), max_to_keep=2)
+if resume_every > 0 and resume_manager.latest_checkpoint is not None:
+    resumable.restore(resume_manager.latest_checkpoint)
+    print('resuming from', resume_manager.latest_checkpoint,
+          f'at epoch {epoch_var.numpy()+1} batch {batch_var.numpy()}')
+
+
 # global step counter
-gstep = 0
+gstep = int(gstep_var.numpy())
+
+# Padding accounting, to show how much of each epoch's computation is wasted on padding.
+# The padding ratio is the fraction of batch frames (or characters) that are padding.
+def padding_counts(d):
+    logmel_mask = d['logmel_mask']
+    ygt_mask    = d['ygt_mask']
+    return np.array([tf.size(logmel_mask).numpy(), tf.math.count_nonzero(logmel_mask).numpy(),
+                     tf.size(ygt_mask).numpy(),    tf.math.count_nonzero(ygt_mask).numpy()])
 
 # training loop
 # If you've already trained a system and saved checkpoints you can kill the training loop after
 # 1 batch (required to set up objects in the optimizer) and then load the latest checkpoint below.
-for epoch in range(num_epochs):
+for epoch in range(int(epoch_var.numpy()), num_epochs):
     start = time.time()
     #
     # reset accumulators
@@ -755,9 +1704,12 @@ for epoch in range(num_epochs):
     train_acc.reset_states()
     val_loss.reset_states()
     val_acc.reset_states()
+    # [total frames, real frames, total chars, real chars] seen this epoch
+    pad_counts = np.zeros(4, dtype=np.int64)
     #
-    for i,d in enumerate(mask_ds):
+    for i,d in enumerate(train_iter, start=int(batch_var.numpy())):
         train_step(d)
+        pad_counts += padding_counts(d)
         # I will monitor training over groups of batches since there will not be many epochs
         if i % 10 == 0:
             print(f'epoch {epoch+1}  batch {i}  train_loss {train_loss.result():.4f}',
@@ -770,9 +1722,30 @@ for epoch in range(num_epochs):
             train_loss.reset_states()
             train_acc.reset_states()
         gstep += 1
+        batch_var.assign(i + 1)
+        if resume_every > 0 and gstep % resume_every == 0:
+            gstep_var.assign(gstep)
+            resume_manager.save(checkpoint_number=gstep)
+    # report the padding ratios
+    frame_pad = 1.0 - pad_counts[1] / pad_counts[0]
+    char_pad  = 1.0 - pad_counts[3] / pad_counts[2]
+    print(f'epoch {epoch+1} frame padding ratio {frame_pad:.4f}  char padding ratio {char_pad:.4f}')
+    with train_summary_writer.as_default():
+        _ = tf.summary.scalar('frame_padding', frame_pad, step=epoch)
+        _ = tf.summary.scalar('char_padding',  char_pad,  step=epoch)
     # save epoch checkpoint
     cp = checkpoint.save(file_prefix=checkpoint_prefix)
     print('saving checkpoint to', cp)
+    # start the next epoch's iterator, and save it in a resumable checkpoint so a restart begins there
+    epoch_var.assign_add(1)
+    batch_var.assign(0)
+    gstep_var.assign(gstep)
+    if epoch + 1 < num_epochs:
+        train_iter = iter(mask_ds)
+        if svc_target is None:
+            resumable.iterator = train_iter
+    if resume_every > 0:
+        resume_manager.save(checkpoint_number=gstep)
     # validate epoch
     print('validating', end='', flush=True)
     for i,d in enumerate(dmk_ds):
@@ -796,14 +1769,11 @@ for epoch in range(num_epochs):
 # Load the latest checkpoint from disk
 status = checkpoint.restore(tf.train.latest_checkpoint(checkpoint_directory))
 status.assert_consumed()
+if fold_norm:
+    las.fold_normalization()
 
 # set up a new dev_clean data pipeline with no wav_augment and batch_size=4
-dtr_ds    = dfi_ds.map(transform)
-dno_ds    = dtr_ds.map(normalize)
-dpd_ds    = dno_ds.padded_batch(
-    batch_size=4,
-    padded_shapes=({'logmels' : (None, mel_dim), 'speaker_id' : (), 'ygt' : (None, voc_dim)}))
-dmk_ds    = dpd_ds.map(gen_masks)
+dmk_ds    = build_pipeline(dev_ds, batch=4, corpus_split=dev_corp)
 
 # First, look at model predictions when teacher-forcing each input character.
 
@@ -811,19 +1781,19 @@ dmk_ds    = dpd_ds.map(gen_masks)
 @tf.autograph.experimental.do_not_convert
 def pred_step(d):
     # ygt is ground truth chars, including start and end characters
-    ygt        = d['ygt']         # (batch, nchars, voc_dim)
+    ygt        = d['ygt']         # (batch, nchars)
     ygt_mask   = d['ygt_mask']    # (batch, nchars)
     # y inputs exclude end character
-    yins       = ygt[:, :-1]      # (batch, nchars, voc_dim)
+    yins       = ygt[:, :-1]      # (batch, nchars)
     yins_mask  = ygt_mask[:, :-1] # (batch, nchars)
     # y targets exclude the start character
-    ytars      = ygt[:, 1:]       # (batch, nchars, voc_dim)
+    ytars      = ygt[:, 1:]       # (batch, nchars)
     ytars_mask = ygt_mask[:, 1:]  # (batch, nchars)
     # blend is False since we want to always use the teacher-forced input char
     blend      = tf.constant(False)
     # call the model to obtain the y predictions (logits) (batch, nchars, voc_dim)
-    # set training to False to switch off any future dropout; this will write junk to awl
-    yps = las([yins, yins_mask, d['logmels'], d['logmel_mask'], blend], training=False)
+    # set training to False to switch off any future dropout
+    yps = las([yins, yins_mask, d['logmels'], d['logmel_len'], blend], training=False)
     return yps, ytars, ytars_mask
 
 
@@ -833,16 +1803,15 @@ print('Predictions when teacher-forcing each input character:\n')
 for i, d in enumerate(dmk_ds):
     # get the predictions, as logits
     yps, ytars, ytars_mask = pred_step(d)
-    # get the targets as a sparse tensor (batch, nchars)
-    sparse_tars = tf.argmax(ytars, axis=-1)
-    sparse_tars = tf.cast(sparse_tars, dtype=tf.int32)
+    # the targets are already a sparse tensor (batch, nchars)
+    sparse_tars = ytars
     # encode into text (batch)
-    tar_text = tf.strings.unicode_encode(sparse_tars, 'UTF-8', replacement_char=63)
+    tar_text = vocab.decode(sparse_tars)
     # argmax over the probabilities of each character -> (batch, nchars)
     sparse_preds = tf.argmax(yps, axis=-1)
     sparse_preds = tf.cast(sparse_preds, dtype=tf.int32)
     # encode into text (batch)
-    pred_text = tf.strings.unicode_encode(sparse_preds, 'UTF-8', replacement_char=63)
+    pred_text = vocab.decode(sparse_preds)
     # compute target lengths (batch)
     lengths = tf.reduce_sum(tf.cast(ytars_mask, tf.int32), axis=-1)
     # printouts
@@ -855,81 +1824,83 @@ for i, d in enumerate(dmk_ds):
 
 # Second, look at predictions as pure decodings, from logmels and the <sos> token:
 
-signature_list = [ tf.TensorSpec(shape=(1, None, mel_dim), dtype=tf.float32),
-                   tf.TensorSpec(shape=(1, None),          dtype=tf.bool) ]
+signature_list = [ tf.TensorSpec(shape=(None, None, mel_dim), dtype=tf.float32),
+                   tf.TensorSpec(shape=(None,),               dtype=tf.int32) ]
 
 @tf.function(input_signature = signature_list)
 @tf.autograph.experimental.do_not_convert
-def decode_step(logmels, logmel_mask):
-    # call the model to obtain the decoded text
-    dec_text = las.decode(logmels, logmel_mask)
-    return dec_text
-
-
-# Produce predictions for 4 examples
+def decode_step(logmels, logmel_len):
+    # call the model to obtain the decoded ids (batch, nchars) and lengths (batch,)
+    return las.decode(logmels, logmel_len)
+
+
+# Greedily decode the logmels of an unbatched pipeline (build_pipeline(..., batch=None)) batch_size at a time.
+# The utterances are sorted by length before batching, so that each batch pads (and decodes) as little
+# as possible, and the transcripts are returned in the pipeline's order.  num limits the number decoded.
+def decode_sorted(ds, batch_size=batch_size, num=None):
+    if num is not None:
+        ds = ds.take(num)
+    examples = [(d['logmels'].numpy(), int(d['logmel_len'])) for d in ds]
+    order    = sorted(range(len(examples)), key=lambda i: examples[i][1])
+    texts    = [None] * len(examples)
+    for b in range(0, len(order), batch_size):
+        rows    = order[b:b + batch_size]
+        frames  = max(examples[i][1] for i in rows)
+        logmels = np.zeros((len(rows), frames, mel_dim), dtype=np.float32)
+        for j, i in enumerate(rows):
+            logmels[j, :examples[i][1]] = examples[i][0][:frames]
+        lens = np.array([examples[i][1] for i in rows], dtype=np.int32)
+        ids, lengths = decode_step(tf.constant(logmels), tf.constant(lens))
+        for i, t, l in zip(rows, vocab.decode(ids).numpy(), lengths.numpy()):
+            texts[i] = t[:l]
+    return texts
+
+
+# Produce predictions for 4 examples, decoded as one batch
 print('Predictions as pure decodings, starting from <sos>:\n')
-for i, d in enumerate(dmk_ds.unbatch().batch(1)):
-    logmels     = d['logmels']                      # (1, frames, mel_dim)
-    logmel_mask = d['logmel_mask']                  # (1, frames)
-    # call decoder
-    dec_st      = decode_step(logmels, logmel_mask) # (nchars,)
-    dec_text    = tf.strings.unicode_encode(dec_st, 'UTF-8', replacement_char=63) # ()
-    # ygt is ground truth chars, including start and end characters
-    ygt         = d['ygt']                          # (1, nchars, voc_dim)
-    ygt_mask    = d['ygt_mask']                     # (1, nchars)
-    # y targets exclude the start character
-    ytars       = ygt[:, 1:]                        # (1, nchars, voc_dim)
-    ytars_mask  = ygt_mask[:, 1:]                   # (1, nchars) 
-    # get the targets as a sparse tensor              (nchars, )
-    sparse_tars = tf.argmax(ytars, axis=-1)
-    sparse_tars = tf.cast(sparse_tars, dtype=tf.int32)
-    sparse_tars = tf.squeeze(sparse_tars)
-    # encode the targets into text                    ()
-    tar_text = tf.strings.unicode_encode(sparse_tars, 'UTF-8', replacement_char=63)
-    # compute target length                           ()
-    length = tf.squeeze(tf.reduce_sum(tf.cast(ytars_mask, tf.int32), axis=-1))
+dev_one  = build_pipeline(dev_ds, batch=None, corpus_split=dev_corp)
+dec_text = decode_sorted(dev_one, num=4)
+for i, d in enumerate(dev_one.take(4)):
+    # the targets exclude the start character
+    tar_text = vocab.decode(d['ygt'][1:])                   # ()
     # printouts
-    print('decoded', dec_text.numpy())
-    print('target ', tar_text.numpy()[:length.numpy()])
+    print('decoded', dec_text[i])
+    print('target ', tar_text.numpy())
     print('\n')
-    if i == 3:
-        break
 
 
 
 # Third, look at speller-listener attention weights when teacher-forcing each character
+@tf.function(input_signature = [signature_dict])
+@tf.autograph.experimental.do_not_convert
 def att_step(d):
     # ygt is ground truth chars, including start and end characters
-    ygt        = d['ygt']         # (batch, nchars, voc_dim)
+    ygt        = d['ygt']         # (batch, nchars)
     ygt_mask   = d['ygt_mask']    # (batch, nchars)
     # y inputs exclude end character
-    yins       = ygt[:, :-1]      # (batch, nchars, voc_dim)
+    yins       = ygt[:, :-1]      # (batch, nchars)
     yins_mask  = ygt_mask[:, :-1] # (batch, nchars)
     # y targets exclude the start character
-    ytars      = ygt[:, 1:]       # (batch, nchars, voc_dim)
+    ytars      = ygt[:, 1:]       # (batch, nchars)
     ytars_mask = ygt_mask[:, 1:]  # (batch, nchars)
     # blend is False since we want to always use the teacher-forced input char
     blend      = tf.constant(False)
-    # training is False to switch on the attention weight logging code
     # call the model to obtain the y predictions (logits) (batch, nchars, voc_dim)
-    yps = las([yins, yins_mask, d['logmels'], d['logmel_mask'], blend], training=False)
-    return yps, ytars, ytars_mask
+    # and the attention weights (batch, nchars, frames/pd)
+    yps, aws = las([yins, yins_mask, d['logmels'], d['logmel_len'], blend], training=False, return_attention=True)
+    return yps, aws, ytars, ytars_mask
 
 
 # set up a new dev_clean data pipeline with no wav_augment and batch_size=1
-dtr_ds    = dfi_ds.map(transform)
-dno_ds    = dtr_ds.map(normalize)
-dba_ds    = dno_ds.batch(1)
-dmk_ds    = dba_ds.map(gen_masks)
+dmk_ds    = build_pipeline(dev_ds, batch=1, corpus_split=dev_corp)
 # extract second validation data example ("horses")
 for i,d in enumerate(dmk_ds):
     if i == 1:
         break
 
-# call att_step(), collecting useful output in awl
-awl     = []
-_, _, _ = att_step(d)
-awa     = tf.convert_to_tensor(awl).numpy()
+# call att_step(), keeping the attention weights of the one example
+_, aws, _, _ = att_step(d)
+awa     = aws[0].numpy()
 awa.shape
 # should be (74, 59) : 74 characters, 472//8 reps
 